@@ -0,0 +1,524 @@
+#!/usr/bin/env python3
+
+# Chunked version of the preprocessing and clustering in 1M_brain_gpu_analysis_multigpu_clariden.ipynb
+# that can also run on CPU-only nodes. The count matrix is streamed from the .h5ad file in blocks
+# of rows (cells) and kept sparse up to the regression, every stage is a dask computation over
+# the blocks. The regression of the QC metrics and the scaling are fused into dense row blocks
+# computed from the sparse ones (--regress-out normal), instead of the transposes of the notebook.
+# Backends:
+#
+#   cpu  numpy, scipy.sparse and scikit-learn
+#   gpu  cupy, cupyx.scipy.sparse and cuML (as in the notebook)
+#
+# Each stage is timed and the timings are written as JSON, e.g.
+#
+#   python sc_pipeline.py --input 1M_brain_cells_10X.sparse.h5ad --backend cpu --workers 8 \
+#       --timings timings-cpu.json --output results-cpu.npz
+
+import json
+import time
+import argparse
+from contextlib import contextmanager
+import numpy as np
+import h5py
+import dask
+import dask.array as da
+
+
+class Backend:
+    # Array and sparse matrix modules of a backend and the copies between host and backend
+
+    def __init__(self, name):
+        self.name = name
+        if name == 'gpu':
+            import cupy
+            import cupyx.scipy.sparse
+            self.xp = cupy
+            self.sparse = cupyx.scipy.sparse
+        else:
+            import scipy.sparse
+            self.xp = np
+            self.sparse = scipy.sparse
+
+    def asarray(self, array):
+        return self.xp.asarray(array)
+
+    def to_host(self, array):
+        return array.get() if self.name == 'gpu' else np.asarray(array)
+
+    def empty_meta(self, dtype=np.float32):
+        return self.xp.empty((0, 0), dtype=dtype)
+
+
+class StageTimes:
+    # Wall time of each stage as structured records. Stages compute or persist their results, so
+    # that the time is spent within the stage and not in a later one.
+
+    def __init__(self, backend):
+        self.backend = backend
+        self.records = []
+
+    @contextmanager
+    def stage(self, name):
+        record = {'stage': name, 'backend': self.backend}
+        start = time.perf_counter()
+        yield record
+        record['seconds'] = time.perf_counter() - start
+        self.records.append(record)
+        print(f"{name:>24}: {record['seconds']:8.2f} s " +
+              ", ".join(f"{key} {value}" for key, value in record.items() if key not in ('stage', 'backend', 'seconds')))
+
+    def write(self, path):
+        with open(path, 'w') as f:
+            json.dump(self.records, f, indent=2)
+
+
+def read_h5ad_layout(path):
+    # Returns the number of cells and the gene names of a sparse (CSR) .h5ad file, written by
+    # anndata >= 0.7 (X group with a shape attribute) or earlier (h5sparse attributes)
+    with h5py.File(path, 'r') as f:
+        matrix = f['X']
+        if not isinstance(matrix, h5py.Group):
+            raise ValueError(f"{path}: X is a dense matrix, expected a sparse count matrix")
+        encoding = matrix.attrs.get('encoding-type', matrix.attrs.get('h5sparse_format', 'csr'))
+        encoding = encoding.decode() if isinstance(encoding, bytes) else encoding
+        if not encoding.startswith('csr'):
+            raise ValueError(f"{path}: X is stored as {encoding}, reading blocks of cells requires CSR")
+        shape = tuple(matrix.attrs['shape'] if 'shape' in matrix.attrs else matrix.attrs['h5sparse_shape'])
+
+        var = f['var']
+        if isinstance(var, h5py.Group):
+            genes = var[var.attrs.get('_index', '_index')][:]
+        else:
+            genes = var['index']
+        genes = np.array([gene.decode() if isinstance(gene, bytes) else str(gene) for gene in genes])
+    return int(shape[0]), genes
+
+
+def read_block(path, start, end, num_genes, backend):
+    # Cells [start, end) as a float32 CSR matrix on the backend, only their part of the file is read
+    with h5py.File(path, 'r') as f:
+        matrix = f['X']
+        indptr = matrix['indptr'][start:end + 1]
+        data = matrix['data'][indptr[0]:indptr[-1]].astype(np.float32)
+        indices = matrix['indices'][indptr[0]:indptr[-1]]
+    indptr = indptr - indptr[0]
+    return backend.sparse.csr_matrix((backend.asarray(data), backend.asarray(indices), backend.asarray(indptr)),
+                                     shape=(end - start, num_genes))
+
+
+def row_sums(block, backend):
+    return backend.xp.asarray(block.sum(axis=1)).ravel()
+
+
+def column_sums(block, backend):
+    return backend.xp.asarray(block.sum(axis=0)).ravel()
+
+
+def scan_block(path, start, end, num_genes, min_genes_per_cell, max_genes_per_cell):
+    # Cells within the gene count limits and the number of them that express each gene, from the
+    # indices of the block only
+    with h5py.File(path, 'r') as f:
+        matrix = f['X']
+        indptr = matrix['indptr'][start:end + 1]
+        genes_per_cell = np.diff(indptr)
+        keep_cells = (genes_per_cell >= min_genes_per_cell) & (genes_per_cell <= max_genes_per_cell)
+        indices = matrix['indices'][indptr[0]:indptr[-1]]
+    rows = np.repeat(keep_cells, genes_per_cell)
+    return keep_cells, np.bincount(indices[rows], minlength=num_genes)
+
+
+def load_block(path, start, end, num_genes, keep_cells, keep_genes, target_sum, backend):
+    # Filtered cells and genes, normalized to target_sum counts per cell and log1p-transformed
+    block = read_block(path, start, end, num_genes, backend)
+    block = block[backend.asarray(np.flatnonzero(keep_cells))][:, backend.asarray(keep_genes)]
+    counts = row_sums(block, backend)
+    counts[counts == 0] = 1
+    block = backend.sparse.diags(target_sum / counts) @ block
+    return block.log1p().astype(np.float32).tocsr()
+
+
+class SparseBlocks:
+    # Row blocks of a sparse matrix as dask.delayed objects with known numbers of rows
+
+    def __init__(self, blocks, rows, num_columns):
+        self.blocks = blocks
+        self.rows = rows
+        self.num_columns = num_columns
+
+    @property
+    def shape(self):
+        return sum(self.rows), self.num_columns
+
+    def map(self, func, *args, num_columns=None):
+        return SparseBlocks([dask.delayed(func)(block, *args) for block in self.blocks], self.rows,
+                            self.num_columns if num_columns is None else num_columns)
+
+    def reduce(self, func, *args):
+        # Sum of func over the blocks, e.g. column statistics
+        return sum(dask.compute(*[dask.delayed(func)(block, *args) for block in self.blocks]))
+
+    def collect(self, func, *args):
+        # Concatenation of per-row results of func over the blocks
+        return dask.compute(*[dask.delayed(func)(block, *args) for block in self.blocks])
+
+    def split(self, values):
+        # Row blocks of a per-cell host array, in the order of the blocks
+        return np.split(values, np.cumsum(self.rows)[:-1])
+
+    def persist(self):
+        return SparseBlocks(list(dask.persist(*self.blocks)), self.rows, self.num_columns)
+
+    def to_dense(self, backend):
+        # Densified row blocks as a dask array
+        dense = [da.from_delayed(dask.delayed(lambda block: block.toarray())(block), shape=(rows, self.num_columns),
+                                 dtype=np.float32, meta=backend.empty_meta())
+                 for block, rows in zip(self.blocks, self.rows)]
+        return da.concatenate(dense, axis=0)
+
+
+def read_with_filter(path, backend, times, row_block=50000, min_genes_per_cell=200, max_genes_per_cell=6000,
+                     min_cells_per_gene=1, target_sum=1e4, persist=False):
+    num_cells, genes = read_h5ad_layout(path)
+    starts = list(range(0, num_cells, row_block))
+    ends = starts[1:] + [num_cells]
+
+    with times.stage('scan') as record:
+        scans = dask.compute(*[dask.delayed(scan_block)(path, start, end, len(genes), min_genes_per_cell,
+                                                        max_genes_per_cell)
+                               for start, end in zip(starts, ends)])
+        cells_per_gene = sum(counts for _, counts in scans)
+        keep_genes = np.flatnonzero(cells_per_gene >= min_cells_per_gene)
+        rows = [int(keep_cells.sum()) for keep_cells, _ in scans]
+        record.update(cells=sum(rows), genes=len(keep_genes), filtered_cells=num_cells - sum(rows),
+                      filtered_genes=len(genes) - len(keep_genes))
+
+    blocks = [dask.delayed(load_block)(path, start, end, len(genes), keep_cells, keep_genes, target_sum, backend)
+              for (start, end), (keep_cells, _) in zip(zip(starts, ends), scans)]
+    matrix = SparseBlocks(blocks, rows, len(keep_genes))
+    if persist:
+        # Keeps the normalized matrix in memory instead of reading it again for every stage
+        with times.stage('load') as record:
+            matrix = matrix.persist()
+            record.update(nnz=int(sum(block.nnz for block in dask.compute(*matrix.blocks))))
+    return matrix, genes[keep_genes]
+
+
+def marker_expression(matrix, genes, markers, backend):
+    columns = [int(np.flatnonzero(genes == marker)[0]) for marker in markers if marker in genes]
+    values = matrix.collect(lambda block: backend.to_host(block[:, backend.asarray(columns)].toarray()))
+    values = np.concatenate(values)
+    return {marker: values[:, i] for i, marker in enumerate(marker for marker in markers if marker in genes)}
+
+
+def column_moments(block, backend):
+    # Column sums of the values and of their squares, in float64 as their difference is small
+    block = block.astype(np.float64)
+    return backend.xp.stack([column_sums(block, backend), column_sums(block.multiply(block), backend)])
+
+
+def mean_var(matrix, backend):
+    # Both moments in one pass over the blocks
+    mean, mean_square = backend.to_host(matrix.reduce(column_moments, backend)) / matrix.shape[0]
+    return mean, mean_square - mean ** 2
+
+
+def highly_variable_genes(matrix, backend, n_top_genes=4000):
+    # Normalized dispersion within bins of the mean expression (cell_ranger flavor, as
+    # rapids_scanpy_funcs.highly_variable_genes_filter), computed on the host
+    mean, variance = mean_var(matrix, backend)
+    mean[mean == 0] = 1e-12
+    dispersion = variance / mean
+    bins = np.digitize(mean, np.percentile(mean, np.arange(10, 105, 5)))
+    normalized = np.full_like(dispersion, np.nan)
+    for b in np.unique(bins):
+        in_bin = bins == b
+        median = np.median(dispersion[in_bin])
+        mad = np.median(np.abs(dispersion[in_bin] - median)) / 0.6744897501960817
+        # Bins without spread (mad 0) give no highly variable genes, like in rapids_scanpy_funcs
+        with np.errstate(divide='ignore', invalid='ignore'):
+            normalized[in_bin] = np.abs(dispersion[in_bin] - median) / mad
+    ranked = np.sort(normalized[~np.isnan(normalized)])[::-1]
+    if len(ranked) == 0:
+        raise ValueError("No gene has a defined normalized dispersion, the expression does not vary across cells")
+    cutoff = ranked[min(n_top_genes, len(ranked)) - 1]
+    return np.nan_to_num(normalized) >= cutoff
+
+
+def qc_metrics(matrix, genes, backend, mito_prefix="mt-"):
+    # Total counts and fraction of mitochondrial counts per cell
+    mito = backend.asarray(np.char.startswith(genes.astype(str), mito_prefix))
+
+    def block_metrics(block):
+        counts = row_sums(block, backend)
+        mito_counts = backend.xp.asarray(block @ mito.astype(np.float32)).ravel()
+        percent_mito = backend.xp.where(counts > 0, mito_counts / backend.xp.maximum(counts, 1e-12), 0)
+        return backend.to_host(counts), backend.to_host(percent_mito)
+
+    metrics = matrix.collect(block_metrics)
+    return np.concatenate([m[0] for m in metrics]), np.concatenate([m[1] for m in metrics])
+
+
+def regress_out_columns(y, regressors, backend):
+    # Residuals of the least-squares fit of every column of y (genes) to the regressors
+    coefficients = backend.xp.linalg.lstsq(regressors, y, rcond=None)[0]
+    return (y - regressors @ coefficients).astype(np.float32)
+
+
+def regress_out(matrix, n_counts, percent_mito, backend, workers):
+    # As in the notebook: the densified matrix is transposed and rechunked by genes, regressed
+    # and transposed and rechunked by cells again (two all-to-all shuffles)
+    num_cells, num_genes = matrix.shape
+    regressors = backend.asarray(np.stack([np.ones(num_cells), n_counts, percent_mito], axis=1).astype(np.float32))
+    dense = matrix.to_dense(backend).T
+    dense = dense.rechunk((max(num_genes // (2 * workers), 1), num_cells))
+    dense = dense.map_blocks(lambda block: regress_out_columns(block.T, regressors, backend).T, dtype=np.float32)
+    return dense.T.rechunk((max(-(-num_cells // (2 * workers)), 1), num_genes))
+
+
+def regression_statistics(block, regressors, backend):
+    # Terms of the normal equations and column sums of the counts and their squares of a row block
+    block = block.astype(np.float64)
+    regressors = backend.asarray(regressors.astype(np.float64))
+    return (regressors.T @ regressors, backend.xp.asarray(block.T @ regressors).T,
+            column_sums(block, backend), column_sums(block.multiply(block), backend))
+
+
+def regress_out_normal(matrix, n_counts, percent_mito, backend):
+    # Least-squares fit of every gene to the regressors from the normal equations, accumulated over
+    # the sparse row blocks in one pass: the Gram matrix R^T R of the regressors is shared by all
+    # genes, so the coefficients are (R^T R)^-1 R^T Y. The mean and variance of the residuals
+    # Y - R B follow from the same sums, without forming the residuals.
+    num_cells = matrix.shape[0]
+    regressors = matrix.split(np.stack([np.ones(num_cells), n_counts, percent_mito], axis=1))
+    parts = dask.compute(*[dask.delayed(regression_statistics)(block, block_regressors, backend)
+                           for block, block_regressors in zip(matrix.blocks, regressors)])
+    gram, projections, sums, squares = [backend.to_host(sum(terms)) for terms in zip(*parts)]
+    coefficients = np.linalg.solve(gram, projections)
+    # The first regressor is the intercept, so the first row of the Gram matrix has the column sums of R
+    mean = (sums - gram[0] @ coefficients) / num_cells
+    residual_squares = (squares - 2 * (coefficients * projections).sum(axis=0)
+                        + (coefficients * (gram @ coefficients)).sum(axis=0))
+    variance = np.maximum(residual_squares / num_cells - mean ** 2, 0)
+    return coefficients, regressors, mean, variance
+
+
+def scale_residuals(block, regressors, coefficients, mean, std, max_value, backend):
+    # Regressed, z-scored and clipped dense row block, with one temporary of the size of the block
+    dense = block.toarray()
+    dense -= backend.asarray(regressors.astype(np.float32)) @ coefficients + mean
+    dense /= std
+    return backend.xp.clip(dense, -max_value, max_value, out=dense)
+
+
+def regress_out_and_scale(matrix, regression, backend, max_value=10):
+    # Dense row blocks of the scaled residuals as a dask array, computed from the sparse blocks
+    coefficients, regressors, mean, variance = regression
+    std = np.sqrt(variance)
+    std[std == 0] = 1
+    coefficients, mean, std = [backend.asarray(values.astype(np.float32)) for values in (coefficients, mean, std)]
+    dense = [da.from_delayed(dask.delayed(scale_residuals)(block, block_regressors, coefficients, mean, std,
+                                                          max_value, backend),
+                             shape=(rows, matrix.num_columns), dtype=np.float32, meta=backend.empty_meta())
+             for block, block_regressors, rows in zip(matrix.blocks, regressors, matrix.rows)]
+    return da.concatenate(dense, axis=0)
+
+
+def scale(dense, max_value=10):
+    # z-scores per gene, clipped at max_value standard deviations
+    std = dense.std(axis=0)
+    dense = (dense - dense.mean(axis=0)) / da.where(std == 0, 1, std)
+    return da.clip(dense, -max_value, max_value)
+
+
+def pca(dense, backend, n_components=50):
+    # Projection on the eigenvectors of the covariance matrix with the largest eigenvalues,
+    # accumulated over the row blocks
+    mean = dense.mean(axis=0, dtype=np.float64)
+    covariance = (dense.T @ dense).astype(np.float64) / dense.shape[0]
+    mean, covariance = dask.compute(mean, covariance)
+    covariance -= backend.xp.outer(mean, mean)
+    eigenvalues, eigenvectors = backend.xp.linalg.eigh(covariance)
+    components = eigenvectors[:, ::-1][:, :n_components].astype(np.float32)
+    # Signs as in scikit-learn (largest loading of each component positive)
+    signs = backend.xp.sign(components[backend.xp.argmax(backend.xp.abs(components), axis=0),
+                                       backend.xp.arange(n_components)])
+    components *= signs
+    projected = (dense - mean.astype(np.float32)) @ components
+    return backend.to_host(projected.compute())
+
+
+def tsne(embedding, backend):
+    if backend.name == 'gpu':
+        from cuml.manifold import TSNE
+    else:
+        from sklearn.manifold import TSNE
+    return backend.to_host(TSNE().fit_transform(backend.asarray(embedding)))
+
+
+def kmeans(embedding, backend, k=35):
+    if backend.name == 'gpu':
+        from cuml.cluster import KMeans
+        model = KMeans(n_clusters=k, init="k-means||", random_state=0)
+    else:
+        from sklearn.cluster import KMeans
+        model = KMeans(n_clusters=k, n_init=1, random_state=0)
+    return backend.to_host(model.fit_predict(backend.asarray(embedding)))
+
+
+def knn(embedding, backend, n_neighbors=15):
+    if backend.name == 'gpu':
+        from cuml.neighbors import NearestNeighbors
+    else:
+        from sklearn.neighbors import NearestNeighbors
+    embedding = backend.asarray(embedding)
+    _, indices = NearestNeighbors(n_neighbors=n_neighbors).fit(embedding).kneighbors(embedding)
+    return backend.to_host(indices)
+
+
+def start_cluster(backend, workers):
+    # A local dask cluster with one worker per GPU or the given number of CPU workers. Without
+    # dask.distributed, the blocks are processed by the threads of this process.
+    if backend.name == 'gpu':
+        from dask_cuda import LocalCUDACluster
+        from dask.distributed import Client
+        return Client(LocalCUDACluster())
+    if workers > 0:
+        try:
+            from dask.distributed import Client, LocalCluster
+        except ImportError:
+            print("dask.distributed is not installed, using the threaded scheduler")
+        else:
+            return Client(LocalCluster(n_workers=workers, threads_per_worker=1))
+    return None
+
+
+def run(args):
+    backend = Backend(args.backend)
+    times = StageTimes(args.backend)
+    client = start_cluster(backend, args.workers)
+    workers = len(client.scheduler_info()['workers']) if client is not None else max(args.workers, 1)
+    results = {}
+    start = time.perf_counter()
+
+    matrix, genes = read_with_filter(args.input, backend, times, row_block=args.row_block,
+                                     min_genes_per_cell=args.min_genes_per_cell,
+                                     max_genes_per_cell=args.max_genes_per_cell,
+                                     target_sum=args.target_sum, persist=args.persist)
+
+    with times.stage('marker_genes') as record:
+        for marker, values in marker_expression(matrix, genes, args.markers, backend).items():
+            results[f"marker_{marker}"] = values
+        record.update(markers=len(results))
+
+    with times.stage('highly_variable_genes') as record:
+        hvg = highly_variable_genes(matrix, backend, n_top_genes=args.n_top_genes)
+        genes = genes[hvg]
+        matrix = matrix.map(lambda block, columns: block[:, columns], backend.asarray(np.flatnonzero(hvg)),
+                            num_columns=len(genes))
+        if args.persist:
+            matrix = matrix.persist()
+        record.update(genes=len(genes))
+    results['genes'] = genes
+
+    with times.stage('qc_metrics'):
+        n_counts, percent_mito = qc_metrics(matrix, genes, backend, mito_prefix=args.mito_prefix)
+
+    if args.regress_out == 'transpose':
+        with times.stage('regress_out') as record:
+            dense = regress_out(matrix, n_counts, percent_mito, backend, workers).persist()
+            record.update(cells=dense.shape[0], genes=dense.shape[1], method=args.regress_out)
+        del matrix
+
+        with times.stage('scale') as record:
+            dense = scale(dense, max_value=args.max_value).persist()
+            record.update(persisted=True)
+    else:
+        with times.stage('regress_out') as record:
+            regression = regress_out_normal(matrix, n_counts, percent_mito, backend)
+            record.update(cells=matrix.shape[0], genes=matrix.shape[1], method=args.regress_out)
+
+        with times.stage('scale') as record:
+            # Without --persist, the scaled blocks are computed from the sparse ones when PCA needs them
+            dense = regress_out_and_scale(matrix, regression, backend, max_value=args.max_value)
+            if args.persist:
+                dense = dense.persist()
+            record.update(persisted=args.persist)
+        del matrix, regression
+
+    with times.stage('pca') as record:
+        results['X_pca'] = pca(dense, backend, n_components=args.n_components)
+        record.update(components=args.n_components)
+    del dense
+
+    if 'tsne' not in args.skip:
+        with times.stage('tsne'):
+            results['X_tsne'] = tsne(results['X_pca'][:, :args.tsne_n_pcs], backend)
+    if 'kmeans' not in args.skip:
+        with times.stage('kmeans'):
+            results['kmeans'] = kmeans(results['X_pca'], backend, k=args.k)
+    if 'knn' not in args.skip:
+        with times.stage('knn'):
+            results['knn'] = knn(results['X_pca'][:, :args.knn_n_pcs], backend, n_neighbors=args.n_neighbors)
+
+    times.records.append({'stage': 'total', 'backend': args.backend, 'seconds': time.perf_counter() - start})
+    print(f"{'total':>24}: {times.records[-1]['seconds']:8.2f} s")
+    if client is not None:
+        client.close()
+    return results, times
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Single-cell RNA-seq preprocessing and clustering')
+
+    parser.add_argument('--input', required=True,
+                        help='sparse (CSR) .h5ad file with the count matrix')
+    parser.add_argument('--backend', choices=['cpu', 'gpu'], default='cpu',
+                        help='numpy/scipy/scikit-learn or cupy/cuML')
+    parser.add_argument('--workers', type=int, default=0,
+                        help='CPU workers of a local dask cluster (0: threads of this process), one per GPU on gpu')
+    parser.add_argument('--row-block', type=int, default=50000,
+                        help='number of cells read and processed per block')
+    parser.add_argument('--persist', action='store_true', default=False,
+                        help='keeps the sparse matrix in memory instead of reading it again for each stage')
+    parser.add_argument('--timings', type=str, default=None,
+                        help='JSON file to write the time of each stage to')
+    parser.add_argument('--output', type=str, default=None,
+                        help='.npz file to write the embeddings, clusters and marker gene expression to')
+    parser.add_argument('--regress-out', choices=['normal', 'transpose'], default='normal',
+                        help='regression of n_counts and percent_mito: normal equations over the sparse row '
+                             'blocks, fused with the scaling (normal), or on the dense matrix transposed to '
+                             'gene blocks as in the notebook (transpose)')
+    parser.add_argument('--skip', nargs='*', choices=['tsne', 'kmeans', 'knn'], default=[],
+                        help='stages after the PCA to skip')
+
+    # Parameters of the notebook
+    parser.add_argument('--mito-prefix', default="mt-",
+                        help='prefix of mitochondrial genes to regress out')
+    parser.add_argument('--markers', nargs='*', default=["Stmn2", "Hes1", "Olig1"],
+                        help='marker genes whose raw expression is saved')
+    parser.add_argument('--min-genes-per-cell', type=int, default=200)
+    parser.add_argument('--max-genes-per-cell', type=int, default=6000)
+    parser.add_argument('--target-sum', type=float, default=1e4,
+                        help='total counts per cell after normalization')
+    parser.add_argument('--n-top-genes', type=int, default=4000,
+                        help='number of highly variable genes to retain')
+    parser.add_argument('--max-value', type=float, default=10,
+                        help='clipping of the scaled values in standard deviations')
+    parser.add_argument('--n-components', type=int, default=50)
+    parser.add_argument('--tsne-n-pcs', type=int, default=20)
+    parser.add_argument('--k', type=int, default=35)
+    parser.add_argument('--n-neighbors', type=int, default=15)
+    parser.add_argument('--knn-n-pcs', type=int, default=50)
+
+    args = parser.parse_args()
+
+    results, times = run(args)
+    if args.timings is not None:
+        times.write(args.timings)
+    if args.output is not None:
+        np.savez(args.output, **results)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,51 +1,178 @@
+#!/usr/bin/env python3
+
+# Benchmark of the collective operations used in distributed training. For each operation and
+# message size, the latency and the algorithmic and bus bandwidth are reported (same definitions
+# as the nccl-tests), e.g. with
+#
+#   sbatch --nodes 4 submit_native_ddp.sh dist_ex/dist_example.py --output logs/collectives
+#
+# The message size is the size of the full buffer, i.e. of the output of all_gather and of the
+# input of reduce_scatter. The bus bandwidth corrects the algorithmic bandwidth for the number
+# of ranks and can be compared to the hardware (link) bandwidth.
+
 import os
+import json
 import time
+import socket
+import argparse
 import torch
 import torch.distributed as dist
 
-print(f"Setting up process group with master at {os.environ['MASTER_ADDR']}:{os.environ['MASTER_PORT']}")
+from launcher import init_distributed
+
+OPS = ['broadcast', 'all_reduce', 'all_gather', 'reduce_scatter', 'barrier']
+# Operations that a backend does not implement. They are skipped on all ranks alike, as a rank
+# failing within a collective would leave the others waiting in it.
+UNSUPPORTED = {'gloo': {'reduce_scatter'}}
+
+
+def parse_size(size):
+    units = {'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3}
+    size = size.upper().rstrip('B')
+    if size and size[-1] in units:
+        return int(float(size[:-1]) * units[size[-1]])
+    return int(size)
+
+
+def message_sizes(min_bytes, max_bytes, factor):
+    size = min_bytes
+    while size <= max_bytes:
+        yield size
+        size *= factor
+
+
+def bus_factor(op, world_size):
+    # Fraction of the buffer that each rank sends (and receives) over its links with the
+    # bandwidth-optimal (ring) algorithms
+    if op == 'all_reduce':
+        return 2 * (world_size - 1) / world_size
+    if op in ('all_gather', 'reduce_scatter'):
+        return (world_size - 1) / world_size
+    return 1.0
+
+
+def make_op(op, num_bytes, world_size, device, dtype):
+    # Returns the operation as a closure and the actual message size, rounded to full elements
+    # (per rank for all_gather and reduce_scatter)
+    element_size = torch.tensor([], dtype=dtype).element_size()
+    if op in ('all_gather', 'reduce_scatter'):
+        chunk = max(num_bytes // (element_size * world_size), 1)
+        numel = chunk * world_size
+    else:
+        numel = max(num_bytes // element_size, 1)
+    buffer = torch.ones(numel, dtype=dtype, device=device)
+
+    if op == 'broadcast':
+        return lambda: dist.broadcast(buffer, src=0), numel * element_size
+    if op == 'all_reduce':
+        return lambda: dist.all_reduce(buffer, op=dist.ReduceOp.SUM), numel * element_size
+    if op == 'all_gather':
+        shard = torch.ones(chunk, dtype=dtype, device=device)
+        if hasattr(dist, 'all_gather_into_tensor') and dist.get_backend() == 'nccl':
+            return lambda: dist.all_gather_into_tensor(buffer, shard), numel * element_size
+        return lambda: dist.all_gather(list(buffer.chunk(world_size)), shard), numel * element_size
+    if op == 'reduce_scatter':
+        shard = torch.empty(chunk, dtype=dtype, device=device)
+        return lambda: dist.reduce_scatter_tensor(shard, buffer), numel * element_size
+    return lambda: dist.barrier(), 0
+
+
+def synchronize(device):
+    if device.type == 'cuda':
+        torch.cuda.synchronize(device)
+
+
+def time_op(run_op, iters, warmup, device):
+    for _ in range(warmup):
+        run_op()
+    synchronize(device)
+    dist.barrier()
+
+    start = time.perf_counter()
+    for _ in range(iters):
+        run_op()
+    synchronize(device)
+    return (time.perf_counter() - start) / iters
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Collective communication benchmark')
 
-dist.init_process_group(backend='nccl', init_method='env://')
+    parser.add_argument('--ops', nargs='+', choices=OPS, default=OPS,
+                        help='collective operations to benchmark')
+    parser.add_argument('--min-bytes', type=parse_size, default=parse_size('8'),
+                        help='smallest message size, e.g. 8, 64K or 1M')
+    parser.add_argument('--max-bytes', type=parse_size, default=parse_size('64M'),
+                        help='largest message size')
+    parser.add_argument('--step-factor', type=int, default=4,
+                        help='factor between consecutive message sizes')
+    parser.add_argument('--iters', type=int, default=20,
+                        help='timed iterations per operation and message size')
+    parser.add_argument('--warmup', type=int, default=5,
+                        help='untimed iterations before the timed ones')
+    parser.add_argument('--dtype', choices=['float32', 'float16', 'bfloat16'], default='float32',
+                        help='element type of the messages')
+    parser.add_argument('--output', type=str, default=None,
+                        help='directory to write the results of each rank to as JSON lines')
+    parser.add_argument('--no-cuda', action='store_true', default=False,
+                        help='benchmarks CPU tensors (Gloo) even if GPUs are available')
 
-local_rank = int(os.environ["LOCAL_RANK"])
-device_id = local_rank
-world_rank = dist.get_rank()
-world_size = dist.get_world_size()
+    args = parser.parse_args()
 
-# Generate initial value on each rank
-if world_rank == 0:
-    initial_value = torch.tensor([3.0]).cuda(device_id)
-    print(f"Generated initial value: {initial_value.item()}")
-else:
-    initial_value = torch.tensor([0.0]).cuda(device_id)
+    # NCCL on GPUs, Gloo on CPUs, ranks from SLURM, torchrun or launcher.py
+    ctx = init_distributed(use_cuda=not args.no_cuda)
+    device = ctx.device
+    world_rank = ctx.rank
+    world_size = ctx.world_size
+    dtype = getattr(torch, args.dtype)
 
-# Share the initial value on all nodes
-dist.broadcast(initial_value, src=0)
-print(f"Working with initial value: {initial_value.item()}")
+    hostnames = [None] * world_size
+    dist.all_gather_object(hostnames, socket.gethostname())
+    setup = {'type': 'setup', 'rank': world_rank, 'world_size': world_size,
+             'nodes': len(set(hostnames)), 'hostname': hostnames[world_rank],
+             'backend': ctx.backend, 'device': str(device), 'dtype': args.dtype,
+             'iters': args.iters, 'warmup': args.warmup,
+             'env': {k: v for k, v in os.environ.items() if k.startswith(('NCCL_', 'FI_', 'OMP_'))}}
 
+    records = [setup]
+    if world_rank == 0:
+        print(f"Benchmarking {', '.join(args.ops)} on {world_size} ranks ({setup['nodes']} nodes, "
+              f"{ctx.backend}, {device.type})")
+        print(f"{'operation':>15} {'bytes':>12} {'latency [us]':>14} {'algbw [GB/s]':>13} {'busbw [GB/s]':>13}")
 
-result = initial_value
+    for op in args.ops:
+        if op in UNSUPPORTED.get(ctx.backend, ()):
+            if world_rank == 0:
+                print(f"{op:>15} not supported by the {ctx.backend} backend")
+            continue
+        sizes = [0] if op == 'barrier' else message_sizes(args.min_bytes, args.max_bytes, args.step_factor)
+        for num_bytes in sizes:
+            run_op, num_bytes = make_op(op, num_bytes, world_size, device, dtype)
+            latency = time_op(run_op, args.iters, args.warmup, device)
 
-for i in range(3):
-    time.sleep(3)
+            # The slowest rank determines the time of a collective
+            slowest = torch.tensor([latency], dtype=torch.float64, device=device)
+            dist.all_reduce(slowest, op=dist.ReduceOp.MAX)
+            algbw = num_bytes / latency / 1e9
+            busbw = algbw * bus_factor(op, world_size)
+            records.append({'type': 'result', 'rank': world_rank, 'op': op, 'bytes': num_bytes,
+                            'latency_us': 1e6 * latency, 'max_latency_us': 1e6 * slowest.item(),
+                            'algbw_GBps': algbw, 'busbw_GBps': busbw})
 
-    # Generate a random value locally
-    random_value = torch.rand(1).cuda(device_id)
-    print(f"Generated random value: {random_value.item()}")
+            if world_rank == 0:
+                algbw = num_bytes / slowest.item() / 1e9
+                busbw = algbw * bus_factor(op, world_size)
+                print(f"{op:>15} {num_bytes:>12} {1e6 * slowest.item():>14.1f} {algbw:>13.3f} {busbw:>13.3f}")
 
-    # Add all local random values and make them available on each rank
-    dist.all_reduce(random_value, op=dist.ReduceOp.SUM)
-    print(f"Mean of random values: {random_value.item()/world_size}")
+    if args.output is not None:
+        os.makedirs(args.output, exist_ok=True)
+        with open(os.path.join(args.output, f"collectives-rank{world_rank}.jsonl"), 'w') as f:
+            f.writelines(json.dumps(record) + "\n" for record in records)
 
-    # Add the sum of random values to the initial value
-    result = result + random_value/world_size
-    print(f"Updated initial value: {result.item()}")
+    # Cleanup distributed environment
+    dist.barrier()
+    dist.destroy_process_group()
 
-# Sync and output the result on master rank
-dist.barrier()
-if world_rank == 0:
-    print(f"Final value is {result.item()}")
 
-# Cleanup distributed environment
-print(f"Finishing and exiting.")
-dist.destroy_process_group()
+if __name__ == "__main__":
+    main()
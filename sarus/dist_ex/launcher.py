@@ -0,0 +1,117 @@
+#!/usr/bin/env python3
+
+# Process group setup shared by the distributed scripts. Ranks are read from torchrun
+# (or export_DDP_vars.sh), from SLURM (srun) or default to a single process. As a script,
+# it starts a number of local processes for testing without SLURM, e.g.
+#
+#   python launcher.py --nprocs 4 script.py [script arguments]
+
+import os
+import sys
+import time
+import socket
+import argparse
+import subprocess
+from types import SimpleNamespace
+import torch
+import torch.distributed as dist
+
+
+def env_ranks():
+    # Returns (rank, local rank, world size) of this process
+    if 'RANK' in os.environ and 'WORLD_SIZE' in os.environ:
+        return int(os.environ['RANK']), int(os.environ.get('LOCAL_RANK', 0)), int(os.environ['WORLD_SIZE'])
+    if 'SLURM_PROCID' in os.environ and 'SLURM_NTASKS' in os.environ:
+        return int(os.environ['SLURM_PROCID']), int(os.environ.get('SLURM_LOCALID', 0)), int(os.environ['SLURM_NTASKS'])
+    return 0, 0, 1
+
+
+def default_backend(use_cuda):
+    # NCCL for GPUs, Gloo for CPUs (also when PyTorch was built without NCCL)
+    if use_cuda and dist.is_nccl_available():
+        return 'nccl'
+    return 'gloo'
+
+
+def init_distributed(use_cuda=True, backend=None):
+    rank, local_rank, world_size = env_ranks()
+
+    use_cuda = use_cuda and torch.cuda.is_available()
+    if use_cuda:
+        device = torch.device('cuda', local_rank % torch.cuda.device_count())
+        torch.cuda.set_device(device)
+    else:
+        device = torch.device('cpu')
+    backend = backend or os.environ.get('DIST_BACKEND') or default_backend(use_cuda)
+
+    # The submit scripts set MASTER_ADDR to the first node, torchrun sets both
+    os.environ.setdefault('MASTER_ADDR', '127.0.0.1')
+    os.environ.setdefault('MASTER_PORT', '29500')
+    if rank == 0:
+        print(f"Setting up {backend} process group of {world_size} ranks with master at "
+              f"{os.environ['MASTER_ADDR']}:{os.environ['MASTER_PORT']}")
+    dist.init_process_group(backend=backend, init_method='env://', rank=rank, world_size=world_size)
+
+    return SimpleNamespace(rank=rank, local_rank=local_rank, world_size=world_size,
+                           device=device, backend=backend)
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def launch(nprocs, command, backend=None, threads=None):
+    # Starts nprocs copies of the command with the environment torchrun would set on a single node
+    master_port = str(free_port())
+    if threads is None:
+        # Divide the CPUs among the processes instead of oversubscribing them
+        threads = max(len(os.sched_getaffinity(0)) // nprocs, 1)
+
+    processes = []
+    for rank in range(nprocs):
+        env = dict(os.environ, RANK=str(rank), LOCAL_RANK=str(rank), WORLD_SIZE=str(nprocs),
+                   LOCAL_WORLD_SIZE=str(nprocs), MASTER_ADDR='127.0.0.1', MASTER_PORT=master_port)
+        env.setdefault('OMP_NUM_THREADS', str(threads))
+        if backend is not None:
+            env['DIST_BACKEND'] = backend
+        processes.append(subprocess.Popen([sys.executable, '-u'] + command, env=env))
+
+    # A failing rank would leave the others blocked in a collective, so stop them
+    returncode = 0
+    try:
+        while None in [process.poll() for process in processes]:
+            failed = [process.returncode for process in processes if process.returncode not in (None, 0)]
+            if failed:
+                returncode = failed[0]
+                for process in processes:
+                    if process.poll() is None:
+                        process.terminate()
+            time.sleep(0.1)
+    except KeyboardInterrupt:
+        for process in processes:
+            process.terminate()
+        raise
+    returncode = returncode or next((process.returncode for process in processes if process.returncode != 0), 0)
+    return returncode
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Runs a distributed script with several local processes')
+
+    parser.add_argument('--nprocs', type=int, default=2,
+                        help='number of processes (ranks) to start')
+    parser.add_argument('--backend', choices=['gloo', 'nccl'], default=None,
+                        help='overrides the backend chosen from the available devices')
+    parser.add_argument('--threads', type=int, default=None,
+                        help='OMP_NUM_THREADS per process if not set (default: CPUs divided by processes)')
+    parser.add_argument('command', nargs=argparse.REMAINDER,
+                        help='script and its arguments')
+
+    args = parser.parse_args()
+    sys.exit(launch(args.nprocs, args.command, args.backend, args.threads))
+
+
+if __name__ == "__main__":
+    main()
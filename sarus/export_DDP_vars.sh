@@ -1,4 +1,4 @@
 export RANK=$SLURM_PROCID
 export LOCAL_RANK=$SLURM_LOCALID
 export WORLD_SIZE=$SLURM_NTASKS
-export MASTER_PORT=29500 # default from torch launcher
\ No newline at end of file
+export MASTER_PORT=${MASTER_PORT:-$((29500 + SLURM_JOB_ID % 1000))} # default from torch launcher, offset by job so that jobs sharing a node do not collide
\ No newline at end of file
@@ -0,0 +1,81 @@
+import numpy as np
+import torch
+import torch.nn.functional as F
+
+
+class BatchAugmentation:
+    # Random crops, horizontal flips, mixup/cutmix and normalization of a whole batch on the device,
+    # after the host-to-device copy. Every transform is a few vectorized operations over the batch,
+    # so augmentation adds no work per sample on the CPU. Random numbers are drawn on the device
+    # (crops, flips) and from numpy (mixup/cutmix), both are restored when resuming.
+
+    def __init__(self, config):
+        if config.random_crop_padding >= config.img_size:
+            # Reflection padding takes the pixels from within the image
+            raise ValueError(f"random_crop_padding {config.random_crop_padding} has to be less than "
+                             f"img_size {config.img_size}")
+        self.crop_padding = config.random_crop_padding
+        self.flip = config.random_flip
+        self.mixup_alpha = config.mixup_alpha
+        self.cutmix_alpha = config.cutmix_alpha
+        self.num_classes = config.num_classes
+        self.mean = config.normalize_mean
+        self.std = config.normalize_std
+        self.stats = {}
+
+    def normalize(self, images):
+        # Also applied for validation and inference
+        if self.mean is None:
+            return images
+        if images.device not in self.stats:
+            self.stats[images.device] = (torch.tensor(self.mean, device=images.device).view(-1, 1, 1),
+                                         torch.tensor(self.std, device=images.device).view(-1, 1, 1))
+        mean, std = self.stats[images.device]
+        return (images - mean) / std
+
+    def random_crop(self, images):
+        # Crops of the original size at a random offset per image from the reflection-padded batch
+        n, _, height, width = images.shape
+        padding = self.crop_padding
+        padded = F.pad(images, (padding,) * 4, mode='reflect')
+        offsets = torch.randint(0, 2 * padding + 1, (2, n, 1), device=images.device)
+        rows = offsets[0] + torch.arange(height, device=images.device)
+        columns = offsets[1] + torch.arange(width, device=images.device)
+        batch = torch.arange(n, device=images.device).view(n, 1, 1)
+        return padded.permute(0, 2, 3, 1)[batch, rows[:, :, None], columns[:, None, :]].permute(0, 3, 1, 2)
+
+    def random_flip(self, images):
+        flip = torch.rand(images.shape[0], device=images.device) < 0.5
+        return torch.where(flip.view(-1, 1, 1, 1), images.flip(-1), images)
+
+    def mix(self, images, labels):
+        # Mixes every image with the one at the mirrored position in the batch, either blended
+        # (mixup) or with a box pasted in (cutmix). The targets become class probabilities.
+        use_cutmix = self.cutmix_alpha > 0 and (self.mixup_alpha <= 0 or np.random.rand() < 0.5)
+        lam = np.random.beta(*(2 * [self.cutmix_alpha if use_cutmix else self.mixup_alpha]))
+        mixed = images.flip(0)
+        if use_cutmix:
+            height, width = images.shape[-2:]
+            cut_height, cut_width = int(height * np.sqrt(1 - lam)), int(width * np.sqrt(1 - lam))
+            center_y, center_x = np.random.randint(height), np.random.randint(width)
+            top, bottom = np.clip([center_y - cut_height // 2, center_y + cut_height // 2], 0, height)
+            left, right = np.clip([center_x - cut_width // 2, center_x + cut_width // 2], 0, width)
+            images = images.clone()
+            images[..., top:bottom, left:right] = mixed[..., top:bottom, left:right]
+            # Fraction of each image that was kept after clipping the box
+            lam = 1 - (bottom - top) * (right - left) / (height * width)
+        else:
+            images = images.lerp(mixed, 1 - lam)
+        targets = F.one_hot(labels, self.num_classes).float()
+        return images, targets.lerp(targets.flip(0), 1 - lam)
+
+    def __call__(self, images, labels):
+        # Returns the augmented and normalized images and the targets for the loss
+        if self.crop_padding > 0:
+            images = self.random_crop(images)
+        if self.flip:
+            images = self.random_flip(images)
+        targets = labels
+        if self.mixup_alpha > 0 or self.cutmix_alpha > 0:
+            images, targets = self.mix(images, labels)
+        return self.normalize(images), targets
@@ -0,0 +1,166 @@
+#!/usr/bin/env python3
+
+import os
+import math
+import socket
+import argparse
+from types import SimpleNamespace
+import yaml
+import torch
+
+from config import load_config
+from benchmark import measure
+from runtime import numa_nodes, format_cpulist
+from precision import PRECISIONS, check_precision
+
+
+# Recommends the launch parameters and the runtime config of training.py for the allocation it
+# runs in (one process per node, e.g. srun --ntasks-per-node=1): ranks per node, loader workers
+# and threads per rank from the CPU, NUMA and GPU layout, and the largest batch per rank that
+# fits into memory from training steps of the model in the config on synthetic inputs.
+
+def available_memory_mb(device):
+    if device.type == 'cuda':
+        free, _ = torch.cuda.mem_get_info(device)
+        return free / 2**20
+    with open('/proc/meminfo') as f:
+        for line in f:
+            if line.startswith('MemAvailable:'):
+                return int(line.split()[1]) / 2**10
+    raise RuntimeError("MemAvailable is missing from /proc/meminfo")
+
+
+def probe_allocation(device):
+    cpus = sorted(os.sched_getaffinity(0))
+    nodes = numa_nodes()
+    return SimpleNamespace(hostname=socket.gethostname(),
+                           nodes=int(os.environ.get('SLURM_JOB_NUM_NODES', os.environ.get('SLURM_NNODES', 1))),
+                           cpus=cpus, numa_nodes=sorted({nodes.get(cpu, 0) for cpu in cpus}),
+                           gpus=torch.cuda.device_count() if device.type == 'cuda' else 0,
+                           device_name=torch.cuda.get_device_name(device) if device.type == 'cuda' else 'CPU',
+                           memory_mb=available_memory_mb(device))
+
+
+def plan_ranks(allocation, config, ranks_per_node=None, num_workers=None):
+    # One rank per GPU, or per NUMA node on CPU-only nodes, with an equal share of the CPUs.
+    # Loader workers get half of the CPUs of a GPU rank (as num_workers: auto), a quarter of
+    # those of a CPU rank, which also computes on its CPUs. The rest runs the compute threads.
+    ranks_per_node = ranks_per_node or allocation.gpus or len(allocation.numa_nodes)
+    cpus_per_rank = max(len(allocation.cpus) // ranks_per_node, 1)
+    if num_workers is None:
+        num_workers = cpus_per_rank // 2 if allocation.gpus else cpus_per_rank // 4
+    worker_cpus = min(num_workers * config.cpus_per_worker, cpus_per_rank - 1)
+    compute_threads = cpus_per_rank - worker_cpus
+    return SimpleNamespace(ranks_per_node=ranks_per_node, cpus_per_rank=cpus_per_rank, num_workers=num_workers,
+                           compute_threads=compute_threads, interop_threads=min(2, compute_threads))
+
+
+def fit_batch_size(config, precision, device, memory_budget_mb, min_batch_size, max_batch_size, steps, warmup):
+    # Doubles the batch size while the next one is expected to fit into the budget, assuming that
+    # the memory above that of the model and optimizer (measured in each trial before its first
+    # step) grows linearly with the batch size. The peak memory is reset for every trial, on the
+    # CPU through /proc/self/clear_refs.
+    trials = []
+    batch_size = min_batch_size
+    while True:
+        try:
+            throughput, memory_mb, baseline_mb = measure(config, 'train', batch_size, precision, steps, warmup,
+                                                         device)
+        except torch.cuda.OutOfMemoryError:
+            torch.cuda.empty_cache()
+            break
+        fits = memory_mb <= memory_budget_mb
+        trials.append({'batch_size': batch_size, 'images_per_s': round(throughput, 1),
+                       'peak_memory_mb': round(memory_mb), 'baseline_memory_mb': round(baseline_mb), 'fits': fits})
+        print(f"batch {batch_size}: {throughput:.1f} images/s, peak memory {memory_mb:.0f} MiB"
+              + ("" if fits else f" (over the budget of {memory_budget_mb:.0f} MiB)"))
+        next_batch_size = min(2 * batch_size, max_batch_size)
+        expected_mb = baseline_mb + (memory_mb - baseline_mb) * next_batch_size / batch_size
+        if not fits or batch_size == max_batch_size or expected_mb > memory_budget_mb:
+            break
+        batch_size = next_batch_size
+    fitting = [trial['batch_size'] for trial in trials if trial['fits']]
+    return (max(fitting) if fitting else None), trials
+
+
+def write_runtime_config(path, allocation, plan, precision, batch_size, trials):
+    launch = {'nodes': allocation.nodes, 'ranks_per_node': plan.ranks_per_node, 'cpus_per_task': plan.cpus_per_rank}
+    runtime = {'launch': launch,
+               'config': {'num_workers': plan.num_workers, 'compute_threads': plan.compute_threads,
+                          'interop_threads': plan.interop_threads, 'pin_cpus': True,
+                          'micro_batch_size': batch_size},
+               'trials': trials}
+    sbatch = (f"--nodes={allocation.nodes} --ntasks-per-node={plan.ranks_per_node} "
+              f"--cpus-per-task={plan.cpus_per_rank}")
+    with open(path, 'w') as f:
+        f.write(f"# Measured by autotune.py on {allocation.hostname} ({allocation.device_name}, {len(allocation.cpus)} "
+                f"CPUs {format_cpulist(allocation.cpus)}) for {precision} training steps of the model in the config.\n"
+                f"# The config section is read by training.py and training_single.py with --runtime-config,\n"
+                f"# the launch section corresponds to: sbatch {sbatch} ...\n")
+        yaml.safe_dump(runtime, f, sort_keys=False)
+    return sbatch
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Launch parameters and runtime config for the allocation')
+
+    parser.add_argument('--config', type=str,
+                        help='YAML file with model and training hyperparameters')
+    parser.add_argument('--output', type=str, default='runtime.yaml',
+                        help='runtime config to write, for training.py --runtime-config')
+    parser.add_argument('--precision', choices=PRECISIONS, default='fp32',
+                        help='numerical precision of the training steps (autocast)')
+    parser.add_argument('--ranks-per-node', type=int, default=None,
+                        help='ranks per node (default: one per GPU, or per NUMA node without GPUs)')
+    parser.add_argument('--num-workers', type=int, default=None,
+                        help='loader workers per rank (default: from the CPUs per rank)')
+    parser.add_argument('--memory-fraction', type=float, default=0.85,
+                        help='fraction of the free memory of a rank that the training steps may use, the rest '
+                             'is left for gradient buckets, the allocator and loader workers')
+    parser.add_argument('--min-batch-size', type=int, default=8,
+                        help='first batch size per rank to try')
+    parser.add_argument('--steps', type=int, default=5,
+                        help='timed training steps per batch size')
+    parser.add_argument('--warmup', type=int, default=2,
+                        help='untimed steps before the timed ones')
+    parser.add_argument('--no-cuda', action='store_true', default=False,
+                        help='tunes for CPU-only ranks even if a GPU is available')
+
+    args = parser.parse_args()
+
+    config = SimpleNamespace(**load_config(args.config))
+    use_cuda = not args.no_cuda and torch.cuda.is_available()
+    device = torch.device("cuda" if use_cuda else "cpu")
+    check_precision(args.precision, device)
+
+    allocation = probe_allocation(device)
+    plan = plan_ranks(allocation, config, args.ranks_per_node, args.num_workers)
+    print(f"{allocation.nodes} nodes with {len(allocation.cpus)} CPUs (NUMA nodes "
+          f"{','.join(map(str, allocation.numa_nodes))}), {allocation.gpus} GPUs, "
+          f"{allocation.memory_mb:.0f} MiB free {'GPU ' if use_cuda else ''}memory: "
+          f"{plan.ranks_per_node} ranks per node with {plan.cpus_per_rank} CPUs, {plan.num_workers} loader workers "
+          f"and {plan.compute_threads} compute threads")
+
+    # The trial runs like one rank: its compute threads and, on CPUs, its share of the memory
+    torch.set_num_threads(plan.compute_threads)
+    memory_budget_mb = args.memory_fraction * allocation.memory_mb / (1 if use_cuda else plan.ranks_per_node)
+    # A larger batch than the share of the global batch would increase the global batch size
+    max_batch_size = math.ceil(config.global_batch_size / (allocation.nodes * plan.ranks_per_node))
+    batch_size, trials = fit_batch_size(config, args.precision, device, memory_budget_mb,
+                                        min(args.min_batch_size, max_batch_size), max_batch_size,
+                                        args.steps, args.warmup)
+    if batch_size is None:
+        raise RuntimeError(f"A batch of {trials[0]['batch_size'] if trials else args.min_batch_size} does not fit "
+                           f"into {memory_budget_mb:.0f} MiB, try activation_checkpointing: true in the config or "
+                           f"a smaller --min-batch-size")
+    accumulation_steps = math.ceil(config.global_batch_size / (allocation.nodes * plan.ranks_per_node * batch_size))
+    print(f"Batch of {batch_size} per rank ({accumulation_steps} micro-batches per step for the global batch "
+          f"of {config.global_batch_size})")
+
+    sbatch = write_runtime_config(args.output, allocation, plan, args.precision, batch_size, trials)
+    print(f"Wrote {args.output}, launch with: sbatch {sbatch} submit_sarus_ddp.sh vit_ex/training.py ... "
+          f"--runtime-config {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,235 @@
+#!/usr/bin/env python3
+
+import os
+import csv
+import json
+import time
+import socket
+import argparse
+import platform
+import itertools
+import subprocess
+from types import SimpleNamespace
+import torch
+import torch.nn as nn
+from torch import optim
+
+import torch.distributed as dist
+from torch.nn.parallel import DistributedDataParallel
+
+from model import ViT
+from config import load_config
+from precision import PRECISIONS, check_precision, autocast, grad_scaler
+from metrics import reset_peak_memory, peak_memory_mb, current_memory_mb
+from export import synchronize
+from launcher import init_distributed
+
+
+def system_info(device, world_size, backend):
+    # Identifies the code version and hardware that the results were measured on
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except OSError:
+        commit = ''
+    if device.type == 'cuda':
+        device_name = torch.cuda.get_device_name(device)
+    else:
+        device_name = platform.processor() or platform.machine()
+    return {'commit': commit, 'hostname': socket.gethostname(), 'torch': torch.__version__,
+            'device': device.type, 'device_name': device_name, 'world_size': world_size, 'backend': backend}
+
+
+def benchmark_step(model, optimizer, scaler, criterion, images, labels, mode, precision):
+    if mode == 'forward':
+        with torch.inference_mode(), autocast(precision, images.device):
+            model(images)
+        return
+    with autocast(precision, images.device):
+        loss = criterion(model(images), labels)
+    scaler.scale(loss).backward()
+    scaler.step(optimizer)
+    scaler.update()
+    optimizer.zero_grad(set_to_none=True)
+
+
+def measure(config, mode, batch_size, precision, steps, warmup, device, ddp=False):
+    # Images per second and peak memory of one process for synthetic inputs of the given batch size,
+    # and the memory of the model and optimizer before the first step (the part that does not
+    # depend on the batch size, apart from the optimizer state)
+    model = ViT(config).to(device)
+    if ddp:
+        device_ids = [device.index] if device.type == 'cuda' else None
+        model = DistributedDataParallel(model, device_ids=device_ids, output_device=device.index)
+    model.train(mode == 'train')
+    optimizer = optim.Adam(model.parameters(), lr=config.lr)
+    scaler = grad_scaler(precision)
+    criterion = nn.CrossEntropyLoss()
+    synchronize(device)
+    baseline_mb = current_memory_mb(device)
+    images = torch.rand(batch_size, config.n_channels, config.img_size, config.img_size, device=device)
+    labels = torch.randint(config.num_classes, (batch_size,), device=device)
+
+    for _ in range(warmup):
+        benchmark_step(model, optimizer, scaler, criterion, images, labels, mode, precision)
+    synchronize(device)
+    if ddp:
+        dist.barrier()
+    reset_peak_memory(device)
+
+    start = time.perf_counter()
+    for _ in range(steps):
+        benchmark_step(model, optimizer, scaler, criterion, images, labels, mode, precision)
+    synchronize(device)
+    elapsed = time.perf_counter() - start
+    return batch_size * steps / elapsed, peak_memory_mb(device), baseline_mb
+
+
+def try_measure(*args, **kwargs):
+    # Result of measure, or None if the device ran out of memory
+    try:
+        return measure(*args, **kwargs)
+    except torch.cuda.OutOfMemoryError:
+        torch.cuda.empty_cache()
+        return None
+
+
+def all_ranks_ok(ok, device):
+    # Whether every rank succeeded
+    failed = torch.tensor([0 if ok else 1], device=device)
+    dist.all_reduce(failed)
+    return failed.item() == 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Vision Transformer throughput benchmark')
+
+    parser.add_argument('--config', type=str,
+                        help='YAML file with model hyperparameters')
+    parser.add_argument('--output', type=str, default=None,
+                        help='prefix of the .csv and .json files to write the results to')
+    parser.add_argument('--modes', nargs='+', choices=['forward', 'train'], default=['forward', 'train'],
+                        help='forward only (inference) and/or forward, backward and optimizer step')
+    parser.add_argument('--batch-sizes', type=int, nargs='+', default=[32],
+                        help='batch sizes per process (weak scaling) or global (strong scaling)')
+    parser.add_argument('--img-sizes', type=int, nargs='+', default=None,
+                        help='image sizes (default: from the config)')
+    parser.add_argument('--patch-sizes', type=int, nargs='+', default=None,
+                        help='patch sizes (default: from the config)')
+    parser.add_argument('--precisions', nargs='+', choices=PRECISIONS, default=['fp32'],
+                        help='numerical precisions of the forward pass (autocast)')
+    parser.add_argument('--threads', type=int, nargs='+', default=[torch.get_num_threads()],
+                        help='numbers of intra-op threads per process')
+    parser.add_argument('--steps', type=int, default=20,
+                        help='timed steps per measurement')
+    parser.add_argument('--warmup', type=int, default=5,
+                        help='untimed steps before the timed ones')
+    parser.add_argument('--scaling', choices=['weak', 'strong'], default='weak',
+                        help='keeps the batch size per process (weak) or the global batch size (strong) fixed')
+    parser.add_argument('--no-cuda', action='store_true', default=False,
+                        help='benchmarks on the CPU even if a GPU is available')
+    parser.add_argument('--dist', action='store_true', default=False,
+                        help='benchmarks data-parallel training over all ranks')
+
+    args = parser.parse_args()
+
+    config = load_config(args.config)
+
+    if args.dist:
+        # NCCL on GPUs, Gloo on CPUs, ranks from SLURM, torchrun or launcher.py
+        ctx = init_distributed(use_cuda=not args.no_cuda)
+        world_rank, world_size, device, backend = ctx.rank, ctx.world_size, ctx.device, ctx.backend
+    else:
+        use_cuda = not args.no_cuda and torch.cuda.is_available()
+        device = torch.device("cuda" if use_cuda else "cpu")
+        world_rank, world_size, backend = 0, 1, None
+
+    info = system_info(device, world_size, backend)
+    if world_rank == 0:
+        print(f"Benchmarking on {world_size} x {info['device_name']} ({info['device']}), commit {info['commit']}")
+
+    precisions = []
+    for precision in args.precisions:
+        try:
+            check_precision(precision, device)
+            precisions.append(precision)
+        except RuntimeError as e:
+            if world_rank == 0:
+                print(f"Skipping {precision}: {e}")
+
+    results = []
+    sweep = itertools.product(args.img_sizes or [config['img_size']], args.patch_sizes or [config['patch_size']],
+                              precisions, args.threads, args.batch_sizes, args.modes)
+    for img_size, patch_size, precision, threads, batch_size, mode in sweep:
+        if img_size % patch_size != 0:
+            continue
+        torch.set_num_threads(threads)
+        run_config = SimpleNamespace(**dict(config, img_size=img_size, patch_size=patch_size))
+        local_batch_size = batch_size if args.scaling == 'weak' else max(batch_size // world_size, 1)
+
+        result = dict(info, mode=mode, img_size=img_size, patch_size=patch_size, precision=precision,
+                      threads=threads, batch_size=batch_size, local_batch_size=local_batch_size,
+                      scaling=args.scaling)
+        # Baseline of a single process, measured on rank 0 while the other ranks wait
+        baseline, throughput, memory = None, float('nan'), float('nan')
+        ok = True
+        if world_rank == 0:
+            measured = try_measure(run_config, mode, batch_size, precision, args.steps, args.warmup, device)
+            ok = measured is not None
+            if ok:
+                baseline, memory, _ = measured
+                throughput = baseline
+        # The collectives stay outside of the measurements, so that a rank running out of memory
+        # does not leave the others waiting in them
+        if world_size > 1 and all_ranks_ok(ok, device):
+            if mode == 'train':
+                # A rank running out of memory within DDP would leave the others waiting in its
+                # collectives, so each rank first checks that the batch fits without DDP
+                ok = all_ranks_ok(try_measure(run_config, mode, local_batch_size, precision, 1, 1, device)
+                                  is not None, device)
+            # Forward passes do not communicate, so the ranks run independently
+            measured = try_measure(run_config, mode, local_batch_size, precision, args.steps, args.warmup,
+                                   device, ddp=mode == 'train') if ok else None
+            ok = ok and all_ranks_ok(measured is not None, device)
+            if ok:
+                all_measured = [None] * world_size
+                dist.all_gather_object(all_measured, measured)
+                throughputs, memories, _ = zip(*all_measured)
+                # The slowest rank determines the global throughput of synchronous data-parallel training
+                throughput = world_size * min(throughputs) if mode == 'train' else sum(throughputs)
+                memory = max(memories)
+        elif world_size > 1:
+            ok = False
+        if not ok:
+            throughput, memory = float('nan'), float('nan')
+        status = 'ok' if ok else 'oom'
+
+        if world_rank != 0:
+            continue
+        # Ideal scaling: N processes reach N times the single-process throughput for the same
+        # per-process (weak) or global (strong) batch size
+        result.update(images_per_s=throughput, peak_memory_mb=memory, status=status,
+                      baseline_images_per_s=baseline,
+                      scaling_efficiency=throughput / (world_size * baseline) if status == 'ok' else float('nan'))
+        results.append(result)
+        print(f"{mode:>7} img {img_size} patch {patch_size} {precision} {threads} threads batch {batch_size}: "
+              f"{throughput:.1f} images/s, peak memory {memory:.0f} MiB"
+              + (f", {args.scaling} scaling efficiency {100 * result['scaling_efficiency']:.1f}%"
+                 if world_size > 1 else ""))
+
+    if world_rank == 0 and args.output is not None and results:
+        os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+        with open(args.output + ".json", 'w') as f:
+            json.dump(results, f, indent=2)
+        with open(args.output + ".csv", 'w', newline='') as f:
+            writer = csv.DictWriter(f, fieldnames=list(results[0].keys()))
+            writer.writeheader()
+            writer.writerows(results)
+        print(f"Wrote results to {args.output}.csv and {args.output}.json")
+
+    if args.dist:
+        dist.destroy_process_group()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,69 @@
+import os
+import queue
+import random
+import threading
+import numpy as np
+import torch
+
+
+def to_cpu(state):
+    # Copy of a (nested) state dict with all tensors on the CPU, so that training can continue
+    # modifying the originals while the copy is written
+    if isinstance(state, torch.Tensor):
+        return state.detach().to('cpu', copy=True)
+    if isinstance(state, dict):
+        return {k: to_cpu(v) for k, v in state.items()}
+    if isinstance(state, (list, tuple)):
+        return type(state)(to_cpu(v) for v in state)
+    return state
+
+
+def get_rng_state():
+    return {
+        'python': random.getstate(),
+        'numpy': np.random.get_state(),
+        'torch': torch.get_rng_state(),
+        'cuda': torch.cuda.get_rng_state_all() if torch.cuda.is_available() else None,
+    }
+
+
+def set_rng_state(state):
+    random.setstate(state['python'])
+    np.random.set_state(state['numpy'])
+    torch.set_rng_state(state['torch'])
+    if state['cuda'] is not None and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(state['cuda'])
+
+
+class AsyncWriter:
+    # Saves objects with torch.save in a background thread, in the order they were submitted.
+    # Files are written under a temporary name and then renamed, so that an interrupted job never
+    # leaves a partial file behind.
+
+    def __init__(self):
+        self.queue = queue.Queue()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def save(self, state, path):
+        self.queue.put((state, path))
+
+    def _run(self):
+        while True:
+            state, path = self.queue.get()
+            try:
+                torch.save(state, path + ".tmp")
+                os.replace(path + ".tmp", path)
+            except Exception as e:
+                print(f"Failed to write {path}: {e}")
+            finally:
+                self.queue.task_done()
+
+    def wait(self):
+        self.queue.join()
+
+
+def load_checkpoint(path):
+    if not os.path.exists(path):
+        return None
+    return torch.load(path, map_location='cpu', weights_only=False)
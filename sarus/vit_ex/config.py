@@ -0,0 +1,70 @@
+import math
+import yaml
+
+
+# Default validation batch size in training micro-batches
+EVAL_BATCH_FACTOR = 4
+
+# Defaults for options added after the first version of config.yaml, so that
+# configs copied into earlier run directories keep working
+DEFAULTS = {
+    'patch_embedding': 'conv',
+    'num_workers': 'auto',
+    'prefetch_factor': 2,
+    'pin_memory': True,
+    'shuffle_buffer_mb': 128,
+    'compute_threads': 'auto',
+    'interop_threads': None,
+    'cpus_per_worker': 1,
+    'pin_cpus': False,
+    'log_interval': 10,
+    'micro_batch_size': None,
+    'activation_checkpointing': False,
+    'checkpoint_interval': 0,
+    'optimizer_sharding': 'none',
+    'bucket_cap_mb': 25,
+    'gradient_as_bucket_view': False,
+    'static_graph': False,
+    'comm_hook': 'none',
+    'powersgd_rank': 4,
+    'powersgd_start_iter': 100,
+    'random_crop_padding': 0,
+    'random_flip': False,
+    'mixup_alpha': 0.0,
+    'cutmix_alpha': 0.0,
+    'normalize_mean': None,
+    'normalize_std': None,
+    'eval_batch_size': None,
+    'eval_interval': 1,
+    'eval_subset': None,
+    'profile_start_step': None,
+    'profile_steps': 5,
+}
+
+
+def load_config(path, runtime_path=None):
+    with open(path) as f:
+        config = yaml.load(f, Loader=yaml.FullLoader)
+    config = {**DEFAULTS, **config}
+    if runtime_path is not None:
+        # Workers, threads and batch size per rank for the allocation, written by autotune.py
+        with open(runtime_path) as f:
+            config.update(yaml.safe_load(f)['config'])
+    return config
+
+
+def set_batch_sizes(config, world_size):
+    # Splits global_batch_size into micro-batches per rank and gradient accumulation steps.
+    # If the split is not exact, the effective global batch size is rounded up.
+    global_batch_size = config['global_batch_size']
+    micro_batch_size = config['micro_batch_size'] or math.ceil(global_batch_size / world_size)
+    accumulation_steps = math.ceil(global_batch_size / (world_size * micro_batch_size))
+    effective_batch_size = world_size * micro_batch_size * accumulation_steps
+    if effective_batch_size != global_batch_size:
+        print(f"Using a global batch size of {effective_batch_size} instead of {global_batch_size} "
+              f"({world_size} processes x {accumulation_steps} micro-batches of {micro_batch_size})")
+    config['batch_size'] = micro_batch_size
+    config['accumulation_steps'] = accumulation_steps
+    # Evaluation keeps no activations for the backward pass and can use larger batches. They are
+    # limited to the validation samples of a process once these are known (limit_eval_batch_size in data.py).
+    config['eval_batch_size'] = config['eval_batch_size'] or EVAL_BATCH_FACTOR * micro_batch_size
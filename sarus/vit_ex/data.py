@@ -0,0 +1,490 @@
+import os
+import json
+import time
+import shutil
+import itertools
+from functools import partial
+import numpy as np
+import torch
+from torch.utils.data import (Dataset, IterableDataset, Subset, DataLoader, Sampler, BatchSampler, RandomSampler,
+                              SequentialSampler, get_worker_info)
+import torchvision
+from torchvision.transforms import Compose, ToTensor, PILToTensor, Resize
+from torchvision.transforms.functional import resize
+from PIL import Image
+
+from runtime import pin_worker, process_cpus
+
+
+def cache_paths(root, train, img_size):
+    split = "train" if train else "test"
+    prefix = os.path.join(root, "cache", f"cifar10-{split}-{img_size}")
+    return f"{prefix}-images.npy", f"{prefix}-labels.npy"
+
+
+def resized_chunk(images, img_size):
+    # uint8 (N, H, W, C) images as resized uint8 (N, C, H, W)
+    chunk = torch.from_numpy(images).permute(0, 3, 1, 2)
+    if chunk.shape[-2:] != (img_size, img_size):
+        chunk = resize(chunk, [img_size, img_size], antialias=True)
+    return chunk.numpy()
+
+
+def build_cache(root, train, img_size, chunk_size=1000):
+    # Resizes the CIFAR10 split once and stores it as uint8 (N, C, H, W) next to the raw data
+    images_path, labels_path = cache_paths(root, train, img_size)
+    if os.path.exists(images_path) and os.path.exists(labels_path):
+        return images_path, labels_path
+
+    os.makedirs(os.path.dirname(images_path), exist_ok=True)
+    dataset = torchvision.datasets.CIFAR10(root=root, train=train, download=False)
+    num_samples = len(dataset.data)
+
+    # Write to temporary files first so that an interrupted job never leaves a partial cache behind
+    images = np.lib.format.open_memmap(images_path + ".tmp", mode='w+', dtype=np.uint8,
+                                       shape=(num_samples, 3, img_size, img_size))
+    for start in range(0, num_samples, chunk_size):
+        images[start:start + chunk_size] = resized_chunk(dataset.data[start:start + chunk_size], img_size)
+    images.flush()
+    del images
+
+    with open(labels_path + ".tmp", 'wb') as f:
+        np.save(f, np.asarray(dataset.targets, dtype=np.int64))
+
+    os.replace(images_path + ".tmp", images_path)
+    os.replace(labels_path + ".tmp", labels_path)
+    print(f"Cached {num_samples} resized images at {images_path}")
+    return images_path, labels_path
+
+
+def shard_dir(root, train, img_size):
+    split = "train" if train else "test"
+    return os.path.join(root, "shards", f"cifar10-{split}-{img_size}")
+
+
+def record_dtype(img_size):
+    # Image and label of a sample are stored next to each other, so that a shard is read sequentially
+    return np.dtype([('image', np.uint8, (3, img_size, img_size)), ('label', np.int64)])
+
+
+def write_shards(chunks, directory, img_size, shard_size=5000):
+    # Writes (images, labels) chunks of uint8 (N, C, H, W) images as shard-NNNNN.npy files of
+    # shard_size records and an index.json with the number of records per shard. Any dataset
+    # that can be read in chunks can be converted without holding it in memory.
+    tmp_directory = directory + ".tmp"
+    shutil.rmtree(tmp_directory, ignore_errors=True)
+    os.makedirs(tmp_directory)
+
+    shards = []
+    records = np.empty(shard_size, dtype=record_dtype(img_size))
+    filled = 0
+
+    def write_shard(num_records):
+        name = f"shard-{len(shards):05d}.npy"
+        np.save(os.path.join(tmp_directory, name), records[:num_records])
+        shards.append({'file': name, 'num_samples': num_records})
+
+    for images, labels in chunks:
+        offset = 0
+        while offset < len(labels):
+            count = min(shard_size - filled, len(labels) - offset)
+            records['image'][filled:filled + count] = images[offset:offset + count]
+            records['label'][filled:filled + count] = labels[offset:offset + count]
+            filled += count
+            offset += count
+            if filled == shard_size:
+                write_shard(filled)
+                filled = 0
+    if filled > 0:
+        write_shard(filled)
+
+    num_samples = sum(shard['num_samples'] for shard in shards)
+    with open(os.path.join(tmp_directory, "index.json"), 'w') as f:
+        json.dump({'img_size': img_size, 'num_samples': num_samples, 'shards': shards}, f, indent=2)
+    # Like the cache, the shards only appear once they are complete
+    os.replace(tmp_directory, directory)
+    print(f"Wrote {num_samples} records in {len(shards)} shards to {directory}")
+    return directory
+
+
+def build_shards(root, train, img_size, shard_size=5000, chunk_size=1000, seed=0):
+    # Converts a CIFAR10 split to resized shards. The training samples are shuffled once across
+    # the shards, so that every shard contains all classes.
+    directory = shard_dir(root, train, img_size)
+    if os.path.exists(os.path.join(directory, "index.json")):
+        return directory
+
+    os.makedirs(os.path.dirname(directory), exist_ok=True)
+    dataset = torchvision.datasets.CIFAR10(root=root, train=train, download=False)
+    num_samples = len(dataset.data)
+    order = np.random.default_rng(seed).permutation(num_samples) if train else np.arange(num_samples)
+    targets = np.asarray(dataset.targets, dtype=np.int64)
+    chunks = ((resized_chunk(dataset.data[indices], img_size), targets[indices])
+              for indices in (order[start:start + chunk_size] for start in range(0, num_samples, chunk_size)))
+    return write_shards(chunks, directory, img_size, shard_size)
+
+
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.bmp', '.ppm', '.tif', '.tiff', '.webp')
+
+
+class CachedCIFAR10(Dataset):
+    # Indexed with a list of sample indices (from a BatchSampler), a whole batch is gathered
+    # from the memory map in one read. Images stay uint8 until to_device.
+    batched = True
+
+    def __init__(self, root, train, img_size):
+        self.images_path, self.labels_path = cache_paths(root, train, img_size)
+        if not os.path.exists(self.images_path):
+            raise RuntimeError(f"No cached data at {self.images_path}, run build_cache or fetch_cifar10.py first")
+        self.labels = np.load(self.labels_path)
+        self.images = None
+
+    def __len__(self):
+        return len(self.labels)
+
+    def __getitem__(self, index):
+        # Opened lazily so that loader worker processes map the file themselves
+        if self.images is None:
+            self.images = np.load(self.images_path, mmap_mode='r')
+        # Indexing with the list of a batch already gathers a copy from the memory map
+        return torch.from_numpy(np.asarray(self.images[index])), torch.from_numpy(np.asarray(self.labels[index]))
+
+
+class ShardedDataset(IterableDataset):
+    # Streams the records of a sharded split as batches. In each epoch the shards are put in a
+    # random order, and the concatenated records are split into one contiguous range per rank and
+    # loader worker (stream), so that every process only reads its own shards, sequentially.
+    # Records are shuffled within windows of shuffle_buffer_mb MiB, each worker holds about twice
+    # that (the window and its shuffled copy). With equal_split (training)
+    # every stream gets the same number of records and the remainder is dropped, so that all ranks
+    # run the same number of steps. Otherwise (validation) the streams of several ranks are padded
+    # to the same length with records from the start of the split, like DistributedSampler. Like ResumableSampler, skip_samples (per rank) skips the
+    # beginning of an epoch, in the same batch order as without interruption.
+    batched = True
+
+    def __init__(self, directory, batch_size, rank=0, num_replicas=1, num_workers=0, shuffle=False,
+                 shuffle_buffer_mb=128, equal_split=False, seed=0):
+        index_path = os.path.join(directory, "index.json")
+        if not os.path.exists(index_path):
+            raise RuntimeError(f"No shards at {directory}, run build_shards or fetch_cifar10.py first")
+        with open(index_path) as f:
+            self.index = json.load(f)
+        self.directory = directory
+        self.batch_size = batch_size
+        self.rank = rank
+        self.num_replicas = num_replicas
+        self.num_workers = max(num_workers, 1)
+        self.shuffle = shuffle
+        self.equal_split = equal_split
+        self.seed = seed
+        self.num_samples = self.index['num_samples']
+        # Window size in records, bounded in bytes so that it does not grow with the image size
+        record_size = record_dtype(self.index['img_size']).itemsize
+        self.shuffle_buffer = max(int(shuffle_buffer_mb * 2**20) // record_size, 1)
+        self.epoch = 0
+        self.skip_samples = 0
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def _stream_range(self, stream):
+        num_streams = self.num_replicas * self.num_workers
+        if self.equal_split:
+            # Whole batches only, otherwise every worker would end its stream with a partial batch
+            quota = self.num_samples // num_streams
+            if quota >= self.batch_size:
+                quota -= quota % self.batch_size
+            return stream * quota, (stream + 1) * quota
+        if self.num_replicas > 1:
+            # Ranks with fewer batches would leave the others waiting in the collectives of FSDP
+            quota = -(-self.num_samples // num_streams)
+            return stream * quota, (stream + 1) * quota
+        return self.num_samples * stream // num_streams, self.num_samples * (stream + 1) // num_streams
+
+    def _stream_batches(self, stream):
+        start, end = self._stream_range(stream)
+        return -(-(end - start) // self.batch_size)
+
+    def _read(self, start, end):
+        # Records [start, end) of the shards in the order of this epoch, in blocks of at most shuffle_buffer
+        shards = self.index['shards']
+        order = (np.random.default_rng([self.seed, self.epoch]).permutation(len(shards)) if self.shuffle
+                 else range(len(shards)))
+        offset = 0
+        for shard in order:
+            num_records = shards[shard]['num_samples']
+            first, last = max(start - offset, 0), min(end - offset, num_records)
+            if first < last:
+                records = np.load(os.path.join(self.directory, shards[shard]['file']), mmap_mode='r')
+                for block_start in range(first, last, self.shuffle_buffer):
+                    yield np.array(records[block_start:min(block_start + self.shuffle_buffer, last)])
+            offset += num_records
+            if offset >= end:
+                break
+
+    def _batches(self, stream):
+        rng = np.random.default_rng([self.seed, self.epoch, stream])
+        remainder = np.empty(0, dtype=record_dtype(self.index['img_size']))
+        window = []
+        start, end = self._stream_range(stream)
+        # The padding of the last streams wraps around to the start of the split
+        laps = range(start - start % self.num_samples, end, self.num_samples)
+        blocks = itertools.chain(*[self._read(max(start - lap, 0), min(end - lap, self.num_samples)) for lap in laps],
+                                 [None])
+        for block in blocks:
+            if block is not None:
+                window.append(block)
+                if sum(len(records) for records in window) < self.shuffle_buffer:
+                    continue
+            window = (window[0] if len(window) == 1 else np.concatenate(window)) if window else remainder[:0]
+            # Records left over from the previous window start the next batch, the window is
+            # shuffled directly into the same array to avoid another copy
+            records = np.empty(len(remainder) + len(window), dtype=remainder.dtype)
+            records[:len(remainder)] = remainder
+            if self.shuffle:
+                np.take(window, rng.permutation(len(window)), out=records[len(remainder):])
+            else:
+                records[len(remainder):] = window
+            window = []
+            full = len(records) - len(records) % self.batch_size
+            for batch_start in range(0, full, self.batch_size):
+                yield records[batch_start:batch_start + self.batch_size]
+            remainder = records[full:]
+        if len(remainder) > 0:
+            yield remainder
+
+    def __iter__(self):
+        worker = get_worker_info()
+        worker_id, num_workers = (worker.id, worker.num_workers) if worker is not None else (0, 1)
+        if num_workers != self.num_workers:
+            raise RuntimeError(f"ShardedDataset was created for {self.num_workers} loader workers, "
+                               f"not {num_workers}")
+        # The loader takes batches from its workers in turn, so batch i of the epoch comes from
+        # worker i % num_workers. After skipping, worker w continues the stream that comes next.
+        skip_batches = self.skip_samples // self.batch_size
+        local_stream = (worker_id + skip_batches) % num_workers
+        local_skip = max(skip_batches - local_stream + num_workers - 1, 0) // num_workers
+        batches = self._batches(self.rank * num_workers + local_stream)
+        for records in itertools.islice(batches, local_skip, None):
+            yield (torch.from_numpy(np.ascontiguousarray(records['image'])),
+                   torch.from_numpy(np.ascontiguousarray(records['label'])))
+
+    def __len__(self):
+        # Batches of this rank in the current epoch
+        num_batches = sum(self._stream_batches(self.rank * self.num_workers + worker)
+                          for worker in range(self.num_workers))
+        return max(num_batches - self.skip_samples // self.batch_size, 0)
+
+
+class ImageFiles(Dataset):
+    # All image files below a directory in sorted order, without labels (-1)
+
+    def __init__(self, root, img_size):
+        self.paths = sorted(os.path.join(directory, name)
+                            for directory, _, names in os.walk(root)
+                            for name in names if name.lower().endswith(IMAGE_EXTENSIONS))
+        self.transforms = Compose([
+            Resize((img_size, img_size)),
+            PILToTensor()
+        ])
+
+    def __len__(self):
+        return len(self.paths)
+
+    def __getitem__(self, index):
+        with Image.open(self.paths[index]) as image:
+            return self.transforms(image.convert('RGB')), -1
+
+
+class ArrayImages(Dataset):
+    # Images in a .npy file as (N, C, H, W) or (N, H, W, C), either uint8 or float in [0, 1],
+    # without labels (-1). Batches are gathered from the memory map like in CachedCIFAR10.
+    batched = True
+
+    def __init__(self, path, img_size):
+        self.path = path
+        self.img_size = img_size
+        images = np.load(path, mmap_mode='r')
+        self.length = len(images)
+        self.channels_last = images.shape[-1] in (1, 3) and images.shape[1] not in (1, 3)
+        self.images = None
+
+    def __len__(self):
+        return self.length
+
+    def __getitem__(self, index):
+        if self.images is None:
+            self.images = np.load(self.path, mmap_mode='r')
+        images = torch.from_numpy(np.asarray(self.images[index]))
+        if images.is_floating_point():
+            images = images.float()
+        if self.channels_last:
+            images = images.movedim(-1, -3)
+        if images.shape[-2:] != (self.img_size, self.img_size):
+            images = resize(images, [self.img_size, self.img_size], antialias=True)
+        return images, torch.full(images.shape[:-3], -1)
+
+
+def cifar10_dataset(root, train, config, rank=0, num_replicas=1):
+    if getattr(config, 'data_shards', False):
+        # Training shards are reshuffled every epoch and split evenly over the ranks
+        return ShardedDataset(shard_dir(root, train, config.img_size),
+                              config.batch_size if train else config.eval_batch_size,
+                              rank=rank, num_replicas=num_replicas, num_workers=loader_workers(config),
+                              shuffle=train, shuffle_buffer_mb=config.shuffle_buffer_mb, equal_split=train)
+    if config.data_cache:
+        return CachedCIFAR10(root, train, config.img_size)
+
+    transforms = Compose([
+        Resize((config.img_size, config.img_size)),
+        ToTensor()
+    ])
+    return torchvision.datasets.CIFAR10(root=root, train=train, download=False, transform=transforms)
+
+
+def limit_eval_batch_size(dataset, config, num_replicas=1):
+    # A validation batch larger than the samples a process evaluates would only be partly filled
+    num_samples = dataset.num_samples if isinstance(dataset, ShardedDataset) else len(dataset)
+    config.eval_batch_size = max(min(config.eval_batch_size, -(-num_samples // num_replicas)), 1)
+    if isinstance(dataset, ShardedDataset):
+        dataset.batch_size = config.eval_batch_size
+
+
+def subset(dataset, num_samples):
+    # The first num_samples samples, a fixed subset that keeps the batched indexing of the dataset
+    if isinstance(dataset, ShardedDataset):
+        dataset.num_samples = min(num_samples, dataset.num_samples)
+        return dataset
+    samples = Subset(dataset, range(min(num_samples, len(dataset))))
+    samples.batched = getattr(dataset, 'batched', False)
+    return samples
+
+
+class ResumableSampler(Sampler):
+    # Wraps a sampler with a deterministic order per epoch (such as DistributedSampler), so that
+    # an interrupted epoch can be resumed by skipping the samples that were already trained on
+
+    def __init__(self, sampler):
+        self.sampler = sampler
+        self.skip_samples = 0
+
+    def set_epoch(self, epoch):
+        self.sampler.set_epoch(epoch)
+
+    def __iter__(self):
+        return itertools.islice(iter(self.sampler), self.skip_samples, None)
+
+    def __len__(self):
+        return len(self.sampler) - self.skip_samples
+
+
+def default_num_workers(local_rank=0):
+    # Leave half of the CPUs of the process to the training process itself: those allocated with
+    # --cpus-per-task if SLURM starts one rank per task, the share of the local rank if
+    # launcher.py or torchrun start several ranks within one task
+    local_world_size = int(os.environ.get('LOCAL_WORLD_SIZE', 1))
+    if local_world_size > 1:
+        num_cpus = len(os.sched_getaffinity(0)) // local_world_size
+    else:
+        num_cpus = int(os.environ.get('SLURM_CPUS_PER_TASK', len(process_cpus(local_rank))))
+    return num_cpus // 2
+
+
+def loader_workers(config, local_rank=0):
+    # Decided once before configure_runtime pins the process, which narrows its CPUs
+    return default_num_workers(local_rank) if config.num_workers == 'auto' else int(config.num_workers)
+
+
+def make_loader(dataset, batch_size, config, sampler=None, shuffle=False):
+    num_workers = loader_workers(config)
+    use_cuda = not config.no_cuda and torch.cuda.is_available()
+    # Loaders draw their seeds from their own generator, so that the global random state
+    # (restored when resuming from a checkpoint) only depends on the training steps
+    generator = torch.Generator()
+    loader_args = dict(num_workers=num_workers,
+                       pin_memory=config.pin_memory and use_cuda,
+                       generator=generator)
+    runtime = getattr(config, 'runtime', None)
+    if num_workers > 0 and runtime is not None and runtime.pinned and runtime.worker_cpus:
+        loader_args.update(worker_init_fn=partial(pin_worker, runtime.worker_cpus))
+    if num_workers > 0:
+        # Workers of a ShardedDataset are restarted every epoch to pick up its epoch and skip_samples
+        loader_args.update(prefetch_factor=config.prefetch_factor,
+                           persistent_workers=not isinstance(dataset, IterableDataset))
+
+    if isinstance(dataset, IterableDataset):
+        return DataLoader(dataset, batch_size=None, **loader_args)
+    if getattr(dataset, 'batched', False):
+        if sampler is None:
+            sampler = RandomSampler(dataset, generator=generator) if shuffle else SequentialSampler(dataset)
+        return DataLoader(dataset, batch_size=None,
+                          sampler=BatchSampler(sampler, batch_size, drop_last=False), **loader_args)
+    return DataLoader(dataset, batch_size=batch_size, sampler=sampler,
+                      shuffle=shuffle if sampler is None else False, **loader_args)
+
+
+def to_device(images, labels, device):
+    images, labels = images.to(device, non_blocking=True), labels.to(device, non_blocking=True)
+    if images.dtype == torch.uint8:
+        # Cached images are converted to float on the device, same scaling as ToTensor
+        images = images.float().div_(255)
+    return images, labels
+
+
+class DevicePrefetcher:
+    # Iterates over a loader while the next batch is already being copied to the device.
+    # On GPU the copy runs on a side stream. wait_time is the host time blocked on the
+    # loader in the current epoch, step_wait_time the part of it before the current step.
+    # copy_interval is the (start, end) of the copy of the current batch, as CUDA events on GPU.
+
+    def __init__(self, loader, device):
+        self.loader = loader
+        self.device = device
+        self.stream = torch.cuda.Stream(device) if device.type == 'cuda' else None
+        self.wait_time = 0.0
+        self.step_wait_time = 0.0
+        self.copy_interval = None
+
+    def __len__(self):
+        return len(self.loader)
+
+    def _now(self):
+        if self.stream is None:
+            return time.perf_counter()
+        event = torch.cuda.Event(enable_timing=True)
+        event.record(self.stream)
+        return event
+
+    def _fetch(self, loader_iter):
+        start = time.perf_counter()
+        try:
+            images, labels = next(loader_iter)
+        except StopIteration:
+            return None
+        finally:
+            self.step_wait_time += time.perf_counter() - start
+
+        copy_start = self._now()
+        if self.stream is None:
+            batch = to_device(images, labels, self.device)
+        else:
+            with torch.cuda.stream(self.stream):
+                batch = to_device(images, labels, self.device)
+        return batch, (copy_start, self._now())
+
+    def __iter__(self):
+        self.wait_time = 0.0
+        self.step_wait_time = 0.0
+        loader_iter = iter(self.loader)
+        fetched = self._fetch(loader_iter)
+        while fetched is not None:
+            batch, self.copy_interval = fetched
+            if self.stream is not None:
+                current_stream = torch.cuda.current_stream(self.device)
+                current_stream.wait_stream(self.stream)
+                for tensor in batch:
+                    tensor.record_stream(current_stream)
+            fetched = self._fetch(loader_iter)
+            self.wait_time += self.step_wait_time
+            yield batch
+            self.step_wait_time = 0.0
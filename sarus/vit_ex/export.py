@@ -0,0 +1,70 @@
+import os
+import time
+import inspect
+import torch
+
+from model import ViT
+from precision import autocast
+
+
+def synchronize(device):
+    if device.type == 'cuda':
+        torch.cuda.synchronize(device)
+
+
+def report_compile(model, compiled_model, images, labels, criterion, precision, steps=10):
+    # Times forward and backward steps of the eager and the compiled model on the same batch
+    device = images.device
+
+    def timed_step(step_model):
+        synchronize(device)
+        start = time.perf_counter()
+        with autocast(precision, device):
+            loss = criterion(step_model(images), labels)
+        loss.backward()
+        synchronize(device)
+        return time.perf_counter() - start
+
+    compile_time = timed_step(compiled_model)
+    warmup_time = sum(timed_step(compiled_model) for _ in range(2))
+    compiled_time = sum(timed_step(compiled_model) for _ in range(steps)) / steps
+    eager_time = sum(timed_step(model) for _ in range(steps)) / steps
+    model.zero_grad(set_to_none=True)
+
+    print(f"Compilation: first step {compile_time:.2f} s, warm-up {warmup_time:.2f} s, "
+          f"steady state {1000 * compiled_time:.1f} ms/step vs. eager {1000 * eager_time:.1f} ms/step "
+          f"(speedup {eager_time / compiled_time:.2f}x, pays off after "
+          f"{(compile_time + warmup_time) / max(eager_time - compiled_time, 1e-9):.0f} steps)")
+
+
+def artifact_path(training_output):
+    # torch.export supports a dynamic batch dimension from PyTorch 2.2 on, use TorchScript before
+    if 'dynamic_shapes' in inspect.signature(torch.export.export).parameters:
+        return os.path.join(training_output, "best-model.pt2")
+    return os.path.join(training_output, "best-model.ts")
+
+
+def export_model(model, example_images, path):
+    model.eval()
+    if path.endswith(".pt2"):
+        exported = torch.export.export(model, (example_images,),
+                                       dynamic_shapes=({0: torch.export.Dim('batch')},))
+        torch.export.save(exported, path)
+    else:
+        with torch.no_grad():
+            torch.jit.save(torch.jit.trace(model, example_images), path)
+    print(f"Exported model to {path}")
+
+
+def export_best_model(config):
+    # Exported on the CPU so that the artifact can be loaded on any device
+    model = ViT(config)
+    model.load_state_dict(torch.load(os.path.join(config.training_output, "best-weights.pt"), map_location='cpu'))
+    example_images = torch.rand(2, config.n_channels, config.img_size, config.img_size)
+    export_model(model, example_images, artifact_path(config.training_output))
+
+
+def load_artifact(path, device):
+    if path.endswith(".pt2"):
+        return torch.export.load(path).module().to(device)
+    return torch.jit.load(path, map_location=device)
@@ -4,9 +4,17 @@ import os
 import argparse
 import torchvision
 
+from data import build_cache, build_shards
+
 
 parser = argparse.ArgumentParser(description='Fetch CIFAR10 dataset.')
 parser.add_argument('--output', required=True)
+parser.add_argument('--cache-img-size', type=int, nargs='*', default=[],
+                    help='image sizes for which to build the pre-resized memory-mapped cache')
+parser.add_argument('--shard-img-size', type=int, nargs='*', default=[],
+                    help='image sizes for which to convert the dataset to sharded records (--data-shards)')
+parser.add_argument('--shard-size', type=int, default=5000,
+                    help='number of records per shard')
 args = parser.parse_args()
 
 if os.path.isdir(args.output) and len(os.listdir(args.output)) > 0:
@@ -16,3 +24,13 @@ if os.path.isdir(args.output) and len(os.listdir(args.output)) > 0:
 dataset_train = torchvision.datasets.CIFAR10(root=args.output, train=True, download=True)
 dataset_test = torchvision.datasets.CIFAR10(root=args.output, train=False, download=True)
 print(f"Finished fetching training and test dataset to {args.output}:\n{dataset_train}\n{dataset_test}")
+
+# Optionally pre-resize the images for training/inference with --data-cache
+for img_size in args.cache_img_size:
+    build_cache(args.output, True, img_size)
+    build_cache(args.output, False, img_size)
+
+# Optionally convert to sharded records that each rank streams its part of with --data-shards
+for img_size in args.shard_img_size:
+    build_shards(args.output, True, img_size, args.shard_size)
+    build_shards(args.output, False, img_size, args.shard_size)
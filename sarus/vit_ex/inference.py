@@ -1,42 +1,142 @@
 #!/usr/bin/env python3
 
 import os
+import time
 import argparse
-import yaml
-import pickle
+import itertools
 from types import SimpleNamespace
+import numpy as np
 import torch
 import torch.nn as nn
-from torch.utils.data import DataLoader
-import torchvision
-from torchvision.transforms import Compose, ToTensor, Resize
 from torch.hub import tqdm
 
 from model import ViT
-
-
-def eval_fn(config, model, inference_loader, criterion, device):
-    model.eval()
-    total_loss = 0.0
-
-    predictions = []
-
-    for t, data in enumerate(inference_loader):
-        images, labels = data
-        images, labels = images.to(device), labels.to(device)
-
-        logits = model(images)
-        probabilities = nn.functional.softmax(logits, dim=-1)
-        predictions.append(torch.argmax(probabilities, dim=-1))
-
-        loss = criterion(logits, labels)
-
-        total_loss += loss.item()
-        print(f"Inference loss: {total_loss / (t + 1)}")
-        if config.dry_run:
-            break
-    
-    return predictions
+from augment import BatchAugmentation
+from config import load_config
+from runtime import configure_runtime, describe_runtime
+from data import build_cache, cifar10_dataset, ImageFiles, ArrayImages, loader_workers, make_loader, DevicePrefetcher, to_device
+from precision import PRECISIONS, DTYPES, check_precision, weights_filename
+from metrics import peak_memory_mb
+from export import artifact_path, load_artifact
+from quantize import QUANTIZATIONS, check_quantization, quantize_model
+
+
+class PredictionWriter:
+    # Predictions are written in chunks into memory-mapped .npy files while inference is running.
+    # Entries that have not been written yet are -1, so the files can be read at any time with
+    # np.load(..., mmap_mode='r').
+
+    def __init__(self, output_dir, num_samples, top_k):
+        self.labels = np.lib.format.open_memmap(os.path.join(output_dir, "predicted_labels.npy"),
+                                                mode='w+', dtype=np.int64, shape=(num_samples,))
+        self.labels[:] = -1
+        self.top_k = top_k
+        if top_k > 0:
+            self.topk_labels = np.lib.format.open_memmap(os.path.join(output_dir, "topk_labels.npy"),
+                                                         mode='w+', dtype=np.int64, shape=(num_samples, top_k))
+            self.topk_labels[:] = -1
+            self.topk_probabilities = np.lib.format.open_memmap(os.path.join(output_dir, "topk_probabilities.npy"),
+                                                                mode='w+', dtype=np.float32, shape=(num_samples, top_k))
+        self.position = 0
+        self.chunk = []
+
+    def append(self, logits):
+        # Kept on the device until the chunk is written, avoiding a host sync per batch
+        predictions = [torch.argmax(logits, dim=-1)]
+        if self.top_k > 0:
+            probabilities, labels = torch.topk(nn.functional.softmax(logits, dim=-1), self.top_k, dim=-1)
+            predictions += [labels, probabilities]
+        self.chunk.append(predictions)
+
+    def write(self):
+        if not self.chunk:
+            return
+        predictions = [torch.cat(column).cpu().numpy() for column in zip(*self.chunk)]
+        end = self.position + len(predictions[0])
+        self.labels[self.position:end] = predictions[0]
+        self.labels.flush()
+        if self.top_k > 0:
+            self.topk_labels[self.position:end] = predictions[1]
+            self.topk_probabilities[self.position:end] = predictions[2]
+            self.topk_labels.flush()
+            self.topk_probabilities.flush()
+        self.position = end
+        self.chunk = []
+
+
+def load_model(config, device):
+    # The exported artifact or the model from the training output in the inference precision, also used by serve.py
+    if config.from_artifact:
+        # Exported in evaluation mode already
+        model = load_artifact(artifact_path(config.training_output), device)
+    else:
+        model = ViT(config).to(device)
+
+        # Use the reduced-precision weights exported during training if available, otherwise cast
+        weights_path = os.path.join(config.training_output, weights_filename(config.precision))
+        if not os.path.exists(weights_path):
+            weights_path = os.path.join(config.training_output, "best-weights.pt")
+        model.load_state_dict(torch.load(weights_path, map_location=device))
+        model.eval()
+
+    return model.to(device, DTYPES[config.precision])
+
+
+def eval_fn(config, model, inference_loader, criterion, device, writer, augmentation, reference=None):
+    total_loss = torch.zeros((), device=device)
+    num_correct = torch.zeros((), dtype=torch.int64, device=device)
+    num_batches, num_images = 0, 0
+    start_time = time.perf_counter()
+    # Comparison of a quantized model with the fp32 reference on the same batches (on the CPU)
+    num_agree, reference_correct, max_difference = 0, 0, 0.0
+    model_time, reference_time = 0.0, 0.0
+
+    with torch.inference_mode():
+        for images, labels in DevicePrefetcher(inference_loader, device):
+
+            # Inputs are normalized like during training
+            images = augmentation.normalize(images)
+            model_start = time.perf_counter()
+            logits = model(images.to(DTYPES[config.precision])).float()
+            model_time += time.perf_counter() - model_start
+            writer.append(logits)
+
+            if config.input_format == 'cifar10':
+                total_loss += criterion(logits, labels)
+                num_correct += (torch.argmax(logits, dim=-1) == labels).sum()
+
+            if reference is not None:
+                reference_start = time.perf_counter()
+                reference_logits = reference(images)
+                reference_time += time.perf_counter() - reference_start
+                num_agree += (torch.argmax(logits, dim=-1) == torch.argmax(reference_logits, dim=-1)).sum().item()
+                reference_correct += (torch.argmax(reference_logits, dim=-1) == labels).sum().item()
+                max_difference = max(max_difference, (logits - reference_logits).abs().max().item())
+
+            num_batches += 1
+            num_images += images.shape[0]
+            if num_batches % config.write_interval == 0:
+                writer.write()
+                print(f"Inference: {num_images}/{len(inference_loader.dataset)} images")
+            if config.dry_run:
+                break
+
+    if num_images == 0:
+        raise RuntimeError(f"No images to run inference on in {config.inference_input}")
+    writer.write()
+    inference_time = time.perf_counter() - start_time
+    if config.input_format == 'cifar10':
+        print(f"Inference loss: {total_loss.item() / num_batches}, accuracy: {num_correct.item() / num_images}")
+    print(f"{config.precision} throughput {num_images / inference_time:.1f} images/s, "
+          f"peak memory {peak_memory_mb(device):.0f} MiB")
+    if reference is not None:
+        print(f"int8 {config.quantize} vs. fp32: predictions agree for {100 * num_agree / num_images:.2f}% "
+              f"of the images, max. logit difference {max_difference:.4f}, model time {model_time:.2f} s "
+              f"vs. {reference_time:.2f} s (speedup {reference_time / model_time:.2f}x)")
+        if config.input_format == 'cifar10':
+            accuracy, reference_accuracy = num_correct.item() / num_images, reference_correct / num_images
+            print(f"int8 {config.quantize} accuracy {accuracy:.4f} vs. fp32 {reference_accuracy:.4f} "
+                  f"(drift {accuracy - reference_accuracy:+.4f})")
 
 
 def main():
@@ -46,6 +146,8 @@ def main():
                         help='Path to trained model')
     parser.add_argument('--inference-input', type=str,
                         help='Path to Vision Transformer inference data')
+    parser.add_argument('--input-format', choices=['cifar10', 'images', 'array'], default='cifar10',
+                        help='CIFAR10 test split, directory of image files or .npy array of images')
     parser.add_argument('--config', type=str,
                         help='YAML file with model hyperparameters')
     parser.add_argument('--inference-output', type=str,
@@ -55,11 +157,24 @@ def main():
                         help='disables CUDA training')
     parser.add_argument('--dry-run', action='store_true', default=False,
                         help='quickly check a single pass')
+    parser.add_argument('--data-cache', action='store_true', default=False,
+                        help='reads pre-resized images from a memory-mapped cache (built on first use)')
+    parser.add_argument('--precision', choices=PRECISIONS, default='fp32',
+                        help='numerical precision of the model weights and activations')
+    parser.add_argument('--from-artifact', action='store_true', default=False,
+                        help='loads the model exported with training.py --export instead of the weights')
+    parser.add_argument('--top-k', type=int, default=0,
+                        help='also saves the k most probable labels and their probabilities')
+    parser.add_argument('--write-interval', type=int, default=100,
+                        help='number of batches after which predictions are written to the output')
+    parser.add_argument('--quantize', choices=QUANTIZATIONS, default='none',
+                        help='int8 quantization of the linear layers on the CPU, compared with the fp32 model')
+    parser.add_argument('--calibration-batches', type=int, default=10,
+                        help='batches of the inference data to observe activation ranges on for static quantization')
 
     args = parser.parse_args()
 
-    with open(args.config) as f:
-        config = yaml.load(f, Loader=yaml.FullLoader)
+    config = load_config(args.config)
 
     config['batch_size'] = config['global_batch_size']  # not performed in parallel
     config.update(vars(args))
@@ -67,32 +182,44 @@ def main():
 
     use_cuda = not config.no_cuda and torch.cuda.is_available()
     device = torch.device("cuda" if use_cuda else "cpu")
-
-    transforms = Compose([
-        Resize((config.img_size, config.img_size)),
-        ToTensor()
-    ])
-
-    # This is specifically for the CIFAR10 test dataset as an inference input for demonstration purposes
-    inference_data = torchvision.datasets.CIFAR10(root=config.inference_input, train=False, download=False, transform=transforms)
-    inference_loader = DataLoader(inference_data, batch_size=config.batch_size, shuffle=False)
-
-    model = ViT(config).to(device)
-
-    model.load_state_dict(torch.load(
-        os.path.join(config.training_output, "best-weights.pt")))
-
-    model = model.to(device)
+    check_precision(config.precision, device)
+    check_quantization(config.quantize, device, config.precision)
+    if config.quantize != 'none' and config.from_artifact:
+        raise RuntimeError("--quantize quantizes the model loaded from the weights, not the exported artifact")
+
+    # Compute threads and loader workers on separate CPUs
+    config.num_workers = loader_workers(config)
+    config.runtime = configure_runtime(config, config.num_workers, device)
+    print(f"CPU placement: {describe_runtime(config.runtime)}")
+
+    if config.input_format == 'images':
+        inference_data = ImageFiles(config.inference_input, config.img_size)
+        with open(os.path.join(config.inference_output, "input_files.txt"), 'w') as f:
+            f.writelines(path + "\n" for path in inference_data.paths)
+    elif config.input_format == 'array':
+        inference_data = ArrayImages(config.inference_input, config.img_size)
+    else:
+        if config.data_cache:
+            build_cache(config.inference_input, False, config.img_size)
+        # CIFAR10 test dataset as an inference input for demonstration purposes, loss and accuracy are reported
+        inference_data = cifar10_dataset(config.inference_input, False, config)
+    inference_loader = make_loader(inference_data, config.batch_size, config, shuffle=False)
+
+    model = load_model(config, device)
+
+    augmentation = BatchAugmentation(config)
+    reference = None
+    if config.quantize != 'none':
+        calibration_batches = [augmentation.normalize(to_device(images, labels, device)[0])
+                               for images, labels in itertools.islice(inference_loader, config.calibration_batches)]
+        reference, model = model, quantize_model(model, config.quantize, calibration_batches)
+        print(f"Quantized the linear layers to int8 ({config.quantize}"
+              + (f", calibrated on {len(calibration_batches)} batches)" if config.quantize == 'static' else ")"))
 
     criterion = nn.CrossEntropyLoss()  # well-defined as using test set for demonstration
 
-    predictions = eval_fn(config, model, inference_loader, criterion, device)
-    if use_cuda:
-        predictions = [pred.cpu() for pred in predictions]
-
-    with open(os.path.join(config.inference_output,
-                        f"predicted_labels.pkl"), 'wb') as f:
-        pickle.dump([p.numpy() for p in predictions], f)
+    writer = PredictionWriter(config.inference_output, len(inference_data), config.top_k)
+    eval_fn(config, model, inference_loader, criterion, device, writer, augmentation, reference)
 
 
 if __name__ == "__main__":
@@ -0,0 +1 @@
+../dist_ex/launcher.py
\ No newline at end of file
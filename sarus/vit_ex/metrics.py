@@ -0,0 +1,196 @@
+import json
+import time
+import resource
+from contextlib import contextmanager
+import torch
+from torch.distributed.algorithms.ddp_comm_hooks import default_hooks
+
+
+def _process_status_mb(field):
+    # VmRSS or VmHWM (peak) of this process from /proc, None where it is not available
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith(field + ':'):
+                    return int(line.split()[1]) / 2**10
+    except OSError:
+        pass
+    return None
+
+
+def reset_peak_memory(device):
+    if device.type == 'cuda':
+        torch.cuda.reset_peak_memory_stats(device)
+        return
+    # Resets the peak resident set size (Linux >= 4.0), otherwise it is that of the whole process
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except OSError:
+        pass
+
+
+def peak_memory_mb(device):
+    # Peak allocated device memory on GPU, peak resident set size of the process on CPU
+    if device.type == 'cuda':
+        return torch.cuda.max_memory_allocated(device) / 2**20
+    peak = _process_status_mb('VmHWM')
+    return peak if peak is not None else resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 2**10
+
+
+def current_memory_mb(device):
+    # Allocated device memory on GPU, resident set size of the process on CPU
+    if device.type == 'cuda':
+        return torch.cuda.memory_allocated(device) / 2**20
+    current = _process_status_mb('VmRSS')
+    return current if current is not None else peak_memory_mb(device)
+
+
+class StepTimer:
+    # Times the phases of each training step (data wait, host-to-device copy, augmentation,
+    # forward, backward, optimizer, gradient communication). On GPU, CUDA events are recorded on
+    # the current stream and only resolved when the records are flushed, so that timing does not
+    # synchronize every step. Records are written as JSON lines, one file per rank.
+    PHASES = ('data', 'h2d', 'augment', 'forward', 'backward', 'optimizer', 'comm')
+
+    def __init__(self, device, path=None, append=False):
+        self.device = device
+        self.file = open(path, 'a' if append else 'w') if path is not None else None
+        self.pending = []
+        self.current = None
+        self.totals = self._empty_totals()
+
+    def _empty_totals(self):
+        return dict({phase: 0.0 for phase in self.PHASES}, comm_span=0.0, comm_exposed=0.0,
+                    steps=0, samples=0, time=0.0)
+
+    def now(self):
+        if self.device.type == 'cuda':
+            event = torch.cuda.Event(enable_timing=True)
+            event.record()
+            return event
+        return time.perf_counter()
+
+    def begin(self, epoch, step, data_wait, copy_interval=None):
+        self.current = {'type': 'step', 'epoch': epoch, 'step': step, 'data': data_wait}
+        self.intervals = {phase: [] for phase in self.PHASES[1:]}
+        if copy_interval is not None:
+            self.intervals['h2d'].append(copy_interval)
+        self.start_time = time.perf_counter()
+
+    @contextmanager
+    def phase(self, name):
+        # Also labels the phase in profiler traces
+        with torch.profiler.record_function(name):
+            start = self.now()
+            yield
+            self.add(name, start, self.now())
+
+    def add(self, name, start, end):
+        # Intervals outside of a training step (e.g. during evaluation) are ignored
+        if self.current is not None:
+            self.intervals[name].append((start, end))
+
+    def end(self, num_samples):
+        self.current.update(samples=num_samples, time=time.perf_counter() - self.start_time,
+                            peak_memory_mb=peak_memory_mb(self.device))
+        self.pending.append((self.current, self.intervals))
+        self.current = None
+
+    def flush(self):
+        # Resolves the pending steps (waiting for the device) and writes them
+        if not self.pending:
+            return
+        if self.device.type == 'cuda':
+            torch.cuda.synchronize(self.device)
+        for record, intervals in self.pending:
+            for phase, phase_intervals in intervals.items():
+                record[phase] = sum(elapsed(start, end) for start, end in phase_intervals)
+            record['comm_span'], record['comm_exposed'] = comm_overlap(intervals['comm'])
+            record['samples_per_s'] = record['samples'] / record['time']
+            for key in self.totals:
+                self.totals[key] += 1 if key == 'steps' else record[key]
+            if self.file is not None:
+                self.file.write(json.dumps(record) + "\n")
+        if self.file is not None:
+            self.file.flush()
+        self.pending = []
+
+    def summary(self, epoch):
+        # Totals of the flushed steps since the last summary, in seconds
+        self.flush()
+        summary, self.totals = dict(self.totals, epoch=epoch, type='epoch'), self._empty_totals()
+        return summary
+
+    def write(self, record):
+        if self.file is not None:
+            self.file.write(json.dumps(record) + "\n")
+            self.file.flush()
+
+
+def elapsed(start, end):
+    if isinstance(start, float):
+        return end - start
+    return start.elapsed_time(end) / 1000
+
+
+def comm_overlap(intervals):
+    # Returns the time from the first all-reduce launch to the last completion and the part of it
+    # that is not hidden behind the backward pass. Buckets are launched as soon as their gradients
+    # are ready, so the backward computation ends with the launch of the last bucket.
+    if not intervals:
+        return 0.0, 0.0
+    reference = intervals[0][0]
+    starts = [elapsed(reference, start) for start, _ in intervals]
+    ends = [elapsed(reference, end) for _, end in intervals]
+    return max(ends) - min(starts), max(ends) - max(starts)
+
+
+def overlap_fraction(comm_span, comm_exposed):
+    return 1 - comm_exposed / comm_span if comm_span > 0 else None
+
+
+def timed_comm_hook(timer, hook=default_hooks.allreduce_hook):
+    # DDP communication hook that adds the time from launching the all-reduce of a gradient
+    # bucket to its completion to the comm phase. Buckets are all-reduced during the backward
+    # pass, so comm overlaps with backward.
+    def timed_hook(state, bucket):
+        start = timer.now()
+        future = hook(state, bucket)
+
+        def record(future):
+            timer.add('comm', start, timer.now())
+            return future.value()
+
+        return future.then(record)
+
+    return timed_hook
+
+
+class ProfilerWindow:
+    # Records a torch.profiler trace of num_steps training steps from start_step on (counted over
+    # all epochs of this run), disabled if start_step is None
+    def __init__(self, start_step, num_steps, device, path):
+        self.start_step = start_step
+        self.num_steps = num_steps
+        self.path = path
+        self.activities = [torch.profiler.ProfilerActivity.CPU]
+        if device.type == 'cuda':
+            self.activities.append(torch.profiler.ProfilerActivity.CUDA)
+        self.profiler = None
+
+    def step(self, step):
+        if self.start_step is None:
+            return
+        if step == self.start_step:
+            self.profiler = torch.profiler.profile(activities=self.activities)
+            self.profiler.__enter__()
+        elif step == self.start_step + self.num_steps:
+            self.stop()
+
+    def stop(self):
+        if self.profiler is not None:
+            self.profiler.__exit__(None, None, None)
+            self.profiler.export_chrome_trace(self.path)
+            print(f"Wrote profiler trace to {self.path}")
+            self.profiler = None
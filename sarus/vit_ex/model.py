@@ -1,5 +1,7 @@
 import torch
 import torch.nn as nn
+import torch.nn.functional as F
+from torch.utils.checkpoint import checkpoint
 
 
 class PatchExtractor(nn.Module):
@@ -34,32 +36,92 @@ class InputEmbedding(nn.Module):
         self.patch_size = args.patch_size
         self.n_channels = args.n_channels
         self.latent_size = args.latent_size
-        use_cuda = not args.no_cuda and torch.cuda.is_available()
-        self.device = torch.device("cuda" if use_cuda else "cpu")
-        self.batch_size = args.batch_size
+        self.num_patches = (args.img_size // self.patch_size) ** 2
         self.input_size = self.patch_size * self.patch_size * self.n_channels
-
-        # Linear projection
-        self.LinearProjection = nn.Linear(self.input_size, self.latent_size)
-        # Class token
-        self.class_token = nn.Parameter(torch.randn(self.batch_size, 1, self.latent_size)).to(self.device)
-        # Positional embedding
-        self.pos_embedding = nn.Parameter(torch.randn(self.batch_size, 1, self.latent_size)).to(self.device)
+        self.use_conv = args.patch_embedding == 'conv'
+
+        if self.use_conv:
+            # Patchifying and linear projection in a single strided convolution
+            self.ConvProjection = nn.Conv2d(self.n_channels, self.latent_size,
+                                            kernel_size=self.patch_size, stride=self.patch_size)
+        else:
+            self.patchify = PatchExtractor(patch_size=self.patch_size)
+            # Linear projection
+            self.LinearProjection = nn.Linear(self.input_size, self.latent_size)
+        # Class token, shared by all images in a batch
+        self.class_token = nn.Parameter(torch.randn(1, 1, self.latent_size))
+        # Positional embedding, one per patch plus one for the class token
+        self.pos_embedding = nn.Parameter(torch.randn(1, self.num_patches + 1, self.latent_size))
 
     def forward(self, input_data):
-        input_data = input_data.to(self.device)
-        # Patchifying the Image
-        patchify = PatchExtractor(patch_size=self.patch_size)
-        patches = patchify(input_data)
+        if self.use_conv:
+            # (b, latent, h / p, w / p) -> (b, n, latent)
+            linear_projection = self.ConvProjection(input_data).flatten(2).transpose(1, 2)
+        else:
+            # Patchifying the Image
+            patches = self.patchify(input_data)
+            linear_projection = self.LinearProjection(patches)
 
-        linear_projection = self.LinearProjection(patches).to(self.device)
         b, n, _ = linear_projection.shape
-        linear_projection = torch.cat((self.class_token, linear_projection), dim=1)
+        linear_projection = torch.cat((self.class_token.expand(b, -1, -1), linear_projection), dim=1)
         pos_embed = self.pos_embedding[:, :n + 1, :]
-        linear_projection += pos_embed
+        linear_projection = linear_projection + pos_embed
 
         return linear_projection
 
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        # Earlier checkpoints stored a class token and a single positional embedding per sample
+        # of the batch (or, from GPU runs, neither of them as they were not registered parameters)
+        for name in ('class_token', 'pos_embedding'):
+            key = prefix + name
+            param = getattr(self, name)
+            if key not in state_dict:
+                state_dict[key] = param.detach().clone()
+            elif state_dict[key].shape != param.shape:
+                state_dict[key] = state_dict[key][:1].expand_as(param).clone()
+
+        # Both patch embeddings hold the same weights, flattened in (channel, row, column) order
+        linear_key, conv_key = prefix + 'LinearProjection.', prefix + 'ConvProjection.'
+        if self.use_conv and linear_key + 'weight' in state_dict:
+            state_dict[conv_key + 'weight'] = state_dict.pop(linear_key + 'weight').reshape(
+                self.latent_size, self.n_channels, self.patch_size, self.patch_size)
+            state_dict[conv_key + 'bias'] = state_dict.pop(linear_key + 'bias')
+        elif not self.use_conv and conv_key + 'weight' in state_dict:
+            state_dict[linear_key + 'weight'] = state_dict.pop(conv_key + 'weight').reshape(
+                self.latent_size, self.input_size)
+            state_dict[linear_key + 'bias'] = state_dict.pop(conv_key + 'bias')
+
+        super(InputEmbedding, self)._load_from_state_dict(state_dict, prefix, *args, **kwargs)
+
+
+class SelfAttention(nn.Module):
+    # Batch-first multi-head self-attention using scaled_dot_product_attention, which
+    # dispatches to the fused (flash/memory-efficient) kernels where they are available
+
+    def __init__(self, latent_size, num_heads, dropout):
+        super(SelfAttention, self).__init__()
+        assert latent_size % num_heads == 0, \
+            f"Latent size ({latent_size}) must be divisible by number of heads ({num_heads})"
+        self.num_heads = num_heads
+        self.dropout = dropout
+        self.in_proj = nn.Linear(latent_size, 3 * latent_size)
+        self.out_proj = nn.Linear(latent_size, latent_size)
+
+    def forward(self, input_data):
+        b, n, _ = input_data.shape
+        # (b, n, 3 * latent) -> 3 x (b, heads, n, head_size)
+        query, key, value = self.in_proj(input_data).view(b, n, 3, self.num_heads, -1).permute(2, 0, 3, 1, 4).unbind(0)
+        attention = F.scaled_dot_product_attention(query, key, value,
+                                                   dropout_p=self.dropout if self.training else 0.0)
+        return self.out_proj(attention.transpose(1, 2).reshape(b, n, -1))
+
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        # Checkpoints with nn.MultiheadAttention store the packed input projection as plain tensors
+        for name in ('weight', 'bias'):
+            if prefix + 'in_proj_' + name in state_dict:
+                state_dict[prefix + 'in_proj.' + name] = state_dict.pop(prefix + 'in_proj_' + name)
+        super(SelfAttention, self)._load_from_state_dict(state_dict, prefix, *args, **kwargs)
+
 
 class EncoderBlock(nn.Module):
 
@@ -70,7 +132,7 @@ class EncoderBlock(nn.Module):
         self.num_heads = args.num_heads
         self.dropout = args.dropout
         self.norm = nn.LayerNorm(self.latent_size)
-        self.attention = nn.MultiheadAttention(self.latent_size, self.num_heads, dropout=self.dropout)
+        self.attention = SelfAttention(self.latent_size, self.num_heads, self.dropout)
         self.enc_MLP = nn.Sequential(
             nn.Linear(self.latent_size, self.latent_size * 4),
             nn.GELU(),
@@ -81,7 +143,7 @@ class EncoderBlock(nn.Module):
 
     def forward(self, emb_patches):
         first_norm = self.norm(emb_patches)
-        attention_out = self.attention(first_norm, first_norm, first_norm)[0]
+        attention_out = self.attention(first_norm)
         first_added = attention_out + emb_patches
         second_norm = self.norm(first_added)
         mlp_out = self.enc_MLP(second_norm)
@@ -98,6 +160,7 @@ class ViT(nn.Module):
         self.latent_size = args.latent_size
         self.num_classes = args.num_classes
         self.dropout = args.dropout
+        self.activation_checkpointing = args.activation_checkpointing
 
         self.embedding = InputEmbedding(args)
         # Encoder Stack
@@ -111,7 +174,11 @@ class ViT(nn.Module):
     def forward(self, test_input):
         enc_output = self.embedding(test_input)
         for enc_layer in self.encoders:
-            enc_output = enc_layer(enc_output)
+            if self.activation_checkpointing and self.training:
+                # Only the block inputs are kept, activations inside are recomputed in the backward pass
+                enc_output = checkpoint(enc_layer, enc_output, use_reentrant=False)
+            else:
+                enc_output = enc_layer(enc_output)
 
         class_token_embed = enc_output[:, 0]
         return self.MLPHead(class_token_embed)
@@ -0,0 +1,125 @@
+import torch.distributed as dist
+from torch import optim
+from torch.nn.parallel import DistributedDataParallel
+from torch.distributed.optim import ZeroRedundancyOptimizer
+from torch.distributed.fsdp import (FullyShardedDataParallel, StateDictType, FullStateDictConfig,
+                                    FullOptimStateDictConfig)
+from torch.distributed.fsdp.wrap import ModuleWrapPolicy
+from torch.distributed.fsdp.sharded_grad_scaler import ShardedGradScaler
+from torch.distributed.algorithms.ddp_comm_hooks import default_hooks, powerSGD_hook
+
+from model import EncoderBlock
+from precision import grad_scaler
+
+
+# Data-parallel training either replicates the optimizer state on every rank (none), partitions
+# it across the ranks (zero, ZeroRedundancyOptimizer) or also shards the parameters and gradients
+# of each encoder block (fsdp, FullyShardedDataParallel)
+SHARDINGS = ['none', 'zero', 'fsdp']
+
+
+def unwrap_model(model):
+    # Strips torch.compile and DistributedDataParallel wrappers to get to the ViT module
+    model = getattr(model, '_orig_mod', model)
+    return getattr(model, 'module', model)
+
+
+def wrap_model(model, config, device):
+    if config.optimizer_sharding == 'fsdp':
+        # Ranks start from the initial weights of rank 0 like with DDP (sync_module_states only supports GPUs)
+        for tensor in model.state_dict().values():
+            dist.broadcast(tensor, src=0)
+        return FullyShardedDataParallel(model, auto_wrap_policy=ModuleWrapPolicy({EncoderBlock}),
+                                        device_id=device, use_orig_params=True)
+    # device_ids only applies to GPUs, on CPUs (Gloo) the module stays where it is
+    device_ids = [device.index] if device.type == 'cuda' else None
+    static_graph = config.static_graph
+    if static_graph and config.accumulation_steps > 1:
+        # DDP does not support skipping the gradient synchronization (no_sync) with a static graph
+        print("Not using static_graph with gradient accumulation")
+        static_graph = False
+    return DistributedDataParallel(model, device_ids=device_ids, output_device=device.index,
+                                   bucket_cap_mb=config.bucket_cap_mb,
+                                   gradient_as_bucket_view=config.gradient_as_bucket_view,
+                                   static_graph=static_graph)
+
+
+def comm_hook(config):
+    # Returns the state and the DDP communication hook for the gradient all-reduce. The compression
+    # hooks all-reduce fp16/bf16 copies of the gradient buckets, PowerSGD low-rank approximations
+    # (after plain all-reduces for powersgd_start_iter steps), with error feedback.
+    if config.comm_hook == 'fp16':
+        return None, default_hooks.fp16_compress_hook
+    if config.comm_hook == 'bf16':
+        return None, default_hooks.bf16_compress_hook
+    if config.comm_hook == 'powersgd':
+        state = powerSGD_hook.PowerSGDState(process_group=None,
+                                            matrix_approximation_rank=config.powersgd_rank,
+                                            start_powerSGD_iter=config.powersgd_start_iter)
+        return state, powerSGD_hook.powerSGD_hook
+    return None, default_hooks.allreduce_hook
+
+
+def make_optimizer(model, config):
+    if config.optimizer_sharding == 'zero':
+        return ZeroRedundancyOptimizer(model.parameters(), optimizer_class=optim.Adam,
+                                       lr=config.lr, weight_decay=config.weight_decay)
+    return optim.Adam(model.parameters(), lr=config.lr, weight_decay=config.weight_decay)
+
+
+def make_grad_scaler(config):
+    # Gradients of FSDP are sharded, so inf/nan checks need to be combined over the ranks
+    if config.optimizer_sharding == 'fsdp':
+        return ShardedGradScaler(enabled=config.precision == 'fp16')
+    return grad_scaler(config.precision)
+
+
+def _full_state_dict_type(model, rank0_only):
+    # Gathered on GPU and copied to the CPU tensor by tensor to limit the memory of rank 0. On the
+    # CPU, offloading would alias the gathered buffers, which are reused between tensors.
+    offload_to_cpu = next(model.parameters()).is_cuda
+    return FullyShardedDataParallel.state_dict_type(
+        model, StateDictType.FULL_STATE_DICT,
+        FullStateDictConfig(offload_to_cpu=offload_to_cpu, rank0_only=rank0_only),
+        FullOptimStateDictConfig(offload_to_cpu=offload_to_cpu, rank0_only=rank0_only))
+
+
+# The state dict functions are collective with sharding: all ranks have to call them, the
+# consolidated state is only complete on rank 0. Checkpoints and best-weights.pt therefore have
+# the same format for all sharding options.
+
+def model_state_dict(model, config):
+    if config.optimizer_sharding == 'fsdp':
+        fsdp_model = getattr(model, '_orig_mod', model)
+        with _full_state_dict_type(fsdp_model, rank0_only=True):
+            return fsdp_model.state_dict()
+    return unwrap_model(model).state_dict()
+
+
+def optimizer_state_dict(model, optimizer, config):
+    if config.optimizer_sharding == 'zero':
+        optimizer.consolidate_state_dict(to=0)
+        return optimizer.state_dict() if dist.get_rank() == 0 else None
+    if config.optimizer_sharding == 'fsdp':
+        fsdp_model = getattr(model, '_orig_mod', model)
+        with _full_state_dict_type(fsdp_model, rank0_only=True):
+            return FullyShardedDataParallel.optim_state_dict(fsdp_model, optimizer)
+    return optimizer.state_dict()
+
+
+def load_model_state_dict(model, state_dict, config):
+    if config.optimizer_sharding == 'fsdp':
+        fsdp_model = getattr(model, '_orig_mod', model)
+        with _full_state_dict_type(fsdp_model, rank0_only=False):
+            fsdp_model.load_state_dict(state_dict)
+    else:
+        unwrap_model(model).load_state_dict(state_dict)
+
+
+def load_optimizer_state_dict(model, optimizer, state_dict, config):
+    # Every rank loads the consolidated state and keeps its own partition
+    if config.optimizer_sharding == 'fsdp':
+        fsdp_model = getattr(model, '_orig_mod', model)
+        with _full_state_dict_type(fsdp_model, rank0_only=False):
+            state_dict = FullyShardedDataParallel.optim_state_dict_to_load(fsdp_model, optimizer, state_dict)
+    optimizer.load_state_dict(state_dict)
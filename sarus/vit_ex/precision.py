@@ -0,0 +1,34 @@
+import contextlib
+import torch
+
+
+PRECISIONS = ['fp32', 'bf16', 'fp16']
+DTYPES = {'fp32': torch.float32, 'bf16': torch.bfloat16, 'fp16': torch.float16}
+
+
+def check_precision(precision, device):
+    if precision == 'fp16' and device.type != 'cuda':
+        raise RuntimeError("fp16 precision requires a CUDA device, use bf16 on CPU")
+
+
+def autocast(precision, device):
+    if precision == 'fp32':
+        return contextlib.nullcontext()
+    return torch.autocast(device_type=device.type, dtype=DTYPES[precision])
+
+
+def grad_scaler(precision):
+    # Loss scaling is only needed for the narrow exponent range of fp16
+    enabled = precision == 'fp16'
+    if hasattr(torch.amp, 'GradScaler'):
+        return torch.amp.GradScaler('cuda', enabled=enabled)
+    return torch.cuda.amp.GradScaler(enabled=enabled)  # PyTorch < 2.3
+
+
+def cast_state_dict(state_dict, precision):
+    dtype = DTYPES[precision]
+    return {k: v.to(dtype) if v.is_floating_point() else v for k, v in state_dict.items()}
+
+
+def weights_filename(precision):
+    return "best-weights.pt" if precision == 'fp32' else f"best-weights-{precision}.pt"
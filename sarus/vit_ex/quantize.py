@@ -0,0 +1,76 @@
+import copy
+import torch
+import torch.nn as nn
+from torch.ao import quantization
+
+
+# int8 quantization of the linear layers for inference on CPUs: dynamic (weights quantized ahead
+# of time, activations per batch at run time) or static (activation ranges observed on
+# calibration batches, so that the layers run on int8 inputs)
+QUANTIZATIONS = ['none', 'dynamic', 'static']
+
+
+def check_quantization(quantization_method, device, precision):
+    if quantization_method != 'none' and (device.type != 'cpu' or precision != 'fp32'):
+        raise RuntimeError("int8 quantization runs on the CPU from fp32 weights, use --no-cuda and fp32 precision")
+
+
+def quantized_layer_names(model):
+    # The encoder MLPs, the linear patch embedding and the classification head, which hold most of
+    # the weights. The attention projections and the convolutional patch embedding stay in fp32.
+    names = []
+    for i in range(len(model.encoders)):
+        names += [f"encoders.{i}.enc_MLP.0", f"encoders.{i}.enc_MLP.3"]
+    if not model.embedding.use_conv:
+        names.append("embedding.LinearProjection")
+    names += ["MLPHead.1", "MLPHead.2"]
+    return names
+
+
+class QuantizedInput(nn.Module):
+    # Quantizes the input of a layer and dequantizes its output, for static quantization in eager mode
+
+    def __init__(self, layer):
+        super().__init__()
+        self.quant = quantization.QuantStub()
+        self.layer = layer
+        self.dequant = quantization.DeQuantStub()
+
+    def forward(self, input_data):
+        return self.dequant(self.layer(self.quant(input_data)))
+
+
+def quantization_engine():
+    # x86 (fbgemm with onednn kernels where faster) on PyTorch >= 2.0, qnnpack on ARM CPUs
+    engines = torch.backends.quantized.supported_engines
+    for engine in ('x86', 'fbgemm', 'qnnpack'):
+        if engine in engines:
+            return engine
+    raise RuntimeError("PyTorch was built without a quantization engine")
+
+
+def quantize_model(model, quantization_method, calibration_batches=()):
+    # Returns an int8 copy of the ViT in evaluation mode, the fp32 model is kept as a reference
+    engine = quantization_engine()
+    torch.backends.quantized.engine = engine
+    model = copy.deepcopy(model).eval()
+    names = quantized_layer_names(model)
+
+    if quantization_method == 'dynamic':
+        return quantization.quantize_dynamic(model, {name: quantization.default_dynamic_qconfig for name in names},
+                                             dtype=torch.qint8)
+
+    if not calibration_batches:
+        raise ValueError("Static quantization needs at least one calibration batch")
+    qconfig = quantization.get_default_qconfig(engine)
+    for name in names:
+        parent_name, child_name = name.rsplit('.', 1)
+        parent = model.get_submodule(parent_name)
+        layer = QuantizedInput(getattr(parent, child_name))
+        layer.qconfig = qconfig
+        setattr(parent, child_name, layer)
+    quantization.prepare(model, inplace=True)
+    with torch.no_grad():
+        for images in calibration_batches:
+            model(images)
+    return quantization.convert(model, inplace=True)
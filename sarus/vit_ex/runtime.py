@@ -0,0 +1,131 @@
+import os
+import glob
+from types import SimpleNamespace
+import torch
+
+
+# Placement of the compute threads and loader workers of a process on its CPUs. The CPUs of the
+# process (from --cpus-per-task, or a share of the node for the local ranks of torchrun and
+# launcher.py) are split into a set for the intra-op threads of the training or inference process
+# and one for the loader workers, which are pinned there, so that they do not compete for cores.
+
+def parse_cpulist(cpulist):
+    # "0-3,8,10-11" -> [0, 1, 2, 3, 8, 10, 11]
+    cpus = []
+    for part in cpulist.strip().split(','):
+        if part:
+            first, _, last = part.partition('-')
+            cpus += range(int(first), int(last or first) + 1)
+    return cpus
+
+
+def format_cpulist(cpus):
+    ranges = []
+    for cpu in sorted(set(cpus)):
+        if ranges and cpu == ranges[-1][1] + 1:
+            ranges[-1][1] = cpu
+        else:
+            ranges.append([cpu, cpu])
+    return ','.join(str(first) if first == last else f"{first}-{last}" for first, last in ranges)
+
+
+def numa_nodes():
+    # NUMA node of each CPU, all on node 0 if the topology is not available
+    nodes = {}
+    for path in glob.glob('/sys/devices/system/node/node[0-9]*/cpulist'):
+        node = int(os.path.basename(os.path.dirname(path))[len('node'):])
+        with open(path) as f:
+            nodes.update({cpu: node for cpu in parse_cpulist(f.read())})
+    return nodes
+
+
+def device_numa_node(device):
+    # NUMA node the GPU is attached to, if PyTorch and sysfs report it
+    if device.type != 'cuda':
+        return None
+    properties = torch.cuda.get_device_properties(device)
+    if not hasattr(properties, 'pci_bus_id'):
+        return None
+    address = f"{properties.pci_domain_id:04x}:{properties.pci_bus_id:02x}:{properties.pci_device_id:02x}.0"
+    try:
+        with open(f"/sys/bus/pci/devices/{address}/numa_node") as f:
+            node = int(f.read())
+    except (OSError, ValueError):
+        return None
+    return node if node >= 0 else None
+
+
+def process_cpus(local_rank=0):
+    # Local ranks started by torchrun or launcher.py share the CPUs of the node, SLURM tasks
+    # (srun) are already bound to their own CPUs
+    cpus = sorted(os.sched_getaffinity(0))
+    local_world_size = int(os.environ.get('LOCAL_WORLD_SIZE', 1))
+    if local_world_size > 1 and len(cpus) >= local_world_size:
+        share = len(cpus) // local_world_size
+        cpus = cpus[local_rank * share:(local_rank + 1) * share]
+    return cpus
+
+
+def plan_runtime(config, num_workers, device, local_rank=0):
+    cpus = process_cpus(local_rank)
+    nodes = numa_nodes()
+    # Compute threads on the NUMA node of the GPU (or the first node), loader workers on the rest
+    home_node = device_numa_node(device)
+    cpus.sort(key=lambda cpu: (nodes.get(cpu, 0) != home_node, nodes.get(cpu, 0), cpu))
+
+    num_worker_cpus = min(num_workers * config.cpus_per_worker, len(cpus) - 1) if num_workers > 0 else 0
+    compute_cpus = cpus[:len(cpus) - num_worker_cpus]
+    worker_cpus = cpus[len(cpus) - num_worker_cpus:]
+    # With fewer CPUs than workers, workers share CPUs
+    worker_cpus = [worker_cpus[worker::num_workers] or [worker_cpus[worker % len(worker_cpus)]]
+                   for worker in range(num_workers)] if worker_cpus else []
+
+    compute_threads = len(compute_cpus) if config.compute_threads == 'auto' else int(config.compute_threads)
+    return SimpleNamespace(cpus=sorted(cpus), numa_nodes=sorted({nodes.get(cpu, 0) for cpu in cpus}),
+                           compute_cpus=sorted(compute_cpus), compute_threads=compute_threads,
+                           interop_threads=config.interop_threads, num_workers=num_workers,
+                           worker_cpus=worker_cpus, pinned=config.pin_cpus)
+
+
+def configure_runtime(config, num_workers, device, local_rank=0):
+    # Applies the placement to this process, the workers apply theirs in pin_worker
+    runtime = plan_runtime(config, num_workers, device, local_rank)
+    torch.set_num_threads(runtime.compute_threads)
+    if runtime.interop_threads is not None:
+        try:
+            torch.set_num_interop_threads(runtime.interop_threads)
+        except RuntimeError:
+            # Only possible before the first inter-op parallel work
+            runtime.interop_threads = torch.get_num_interop_threads()
+    else:
+        runtime.interop_threads = torch.get_num_interop_threads()
+    if runtime.pinned:
+        os.sched_setaffinity(0, runtime.compute_cpus)
+    return runtime
+
+
+def pin_worker(worker_cpus, worker_id):
+    # worker_init_fn of the loaders (the loader already limits workers to one thread)
+    os.sched_setaffinity(0, worker_cpus[worker_id])
+
+
+def runtime_record(runtime):
+    # Entry for the metrics files
+    return {'type': 'runtime', 'cpus': format_cpulist(runtime.cpus), 'numa_nodes': runtime.numa_nodes,
+            'compute_cpus': format_cpulist(runtime.compute_cpus), 'compute_threads': runtime.compute_threads,
+            'interop_threads': runtime.interop_threads, 'pinned': runtime.pinned, 'num_workers': runtime.num_workers,
+            'worker_cpus': [format_cpulist(cpus) for cpus in runtime.worker_cpus]}
+
+
+def describe_runtime(runtime):
+    if runtime.worker_cpus:
+        workers = f"{runtime.num_workers} loader workers on CPUs {format_cpulist(sum(runtime.worker_cpus, []))}"
+    elif runtime.num_workers > 0:
+        # A single CPU leaves none for the workers, they share it with the compute threads
+        workers = f"{runtime.num_workers} loader workers on the compute CPUs"
+    else:
+        workers = "no loader workers"
+    return (f"{len(runtime.cpus)} CPUs {format_cpulist(runtime.cpus)} (NUMA nodes "
+            f"{','.join(map(str, runtime.numa_nodes))}): {runtime.compute_threads} compute threads on CPUs "
+            f"{format_cpulist(runtime.compute_cpus)}, {runtime.interop_threads} inter-op threads, {workers}"
+            + ("" if runtime.pinned else " (not pinned)"))
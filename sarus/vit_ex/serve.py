@@ -0,0 +1,335 @@
+#!/usr/bin/env python3
+
+import os
+import json
+import time
+import queue
+import signal
+import socket
+import struct
+import argparse
+import threading
+import socketserver
+from types import SimpleNamespace
+from concurrent.futures import Future
+import numpy as np
+import torch
+import torch.nn as nn
+
+from augment import BatchAugmentation
+from config import load_config
+from runtime import configure_runtime, describe_runtime
+from precision import PRECISIONS, DTYPES, check_precision
+from export import synchronize
+from inference import load_model
+from quantize import check_quantization, quantize_model
+
+
+# Protocol on the Unix or TCP stream socket (little endian): on connecting, the server sends the
+# number of channels, image size and number of classes. A request is the number of images
+# followed by the images as uint8 (N, C, H, W), the response the number of images followed by
+# the class probabilities as float32 (N, num_classes). A connection can send any number of
+# requests one after the other, concurrent requests use several connections.
+HELLO = struct.Struct('<III')
+HEADER = struct.Struct('<I')
+
+
+def latency_summary(latencies, num_requests, num_images, elapsed):
+    latencies = np.asarray(latencies) * 1000
+    return {'requests': num_requests, 'images': num_images, 'seconds': elapsed,
+            'requests_per_s': num_requests / elapsed, 'images_per_s': num_images / elapsed,
+            'latency_p50_ms': float(np.percentile(latencies, 50)) if len(latencies) else float('nan'),
+            'latency_p99_ms': float(np.percentile(latencies, 99)) if len(latencies) else float('nan'),
+            'latency_max_ms': float(latencies.max()) if len(latencies) else float('nan')}
+
+
+class ServerStats:
+    # Latency of every request from its arrival until the response is sent, and the batches run.
+    # Reported for the interval since the last report and for the whole run.
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.start = self.interval_start = time.perf_counter()
+        self.latencies, self.images = [], 0
+        self.interval_latencies, self.interval_images = [], 0
+        self.batches, self.batch_images, self.batch_seconds = 0, 0, 0.0
+
+    def record(self, latency, num_images):
+        with self.lock:
+            self.latencies.append(latency)
+            self.interval_latencies.append(latency)
+            self.images += num_images
+            self.interval_images += num_images
+
+    def record_batch(self, num_images, seconds):
+        with self.lock:
+            self.batches += 1
+            self.batch_images += num_images
+            self.batch_seconds += seconds
+
+    def interval(self):
+        with self.lock:
+            now = time.perf_counter()
+            summary = latency_summary(self.interval_latencies, len(self.interval_latencies), self.interval_images,
+                                      now - self.interval_start)
+            self.interval_latencies, self.interval_images, self.interval_start = [], 0, now
+        return summary
+
+    def total(self):
+        with self.lock:
+            summary = latency_summary(self.latencies, len(self.latencies), self.images,
+                                      time.perf_counter() - self.start)
+            summary.update(batches=self.batches, mean_batch_size=self.batch_images / max(self.batches, 1),
+                           mean_batch_ms=1000 * self.batch_seconds / max(self.batches, 1))
+        return summary
+
+
+def describe_stats(summary):
+    return (f"{summary['requests']} requests, {summary['images_per_s']:.1f} images/s, "
+            f"{summary['requests_per_s']:.1f} requests/s, latency p50 {summary['latency_p50_ms']:.1f} ms, "
+            f"p99 {summary['latency_p99_ms']:.1f} ms")
+
+
+class DynamicBatcher:
+    # Groups the images of concurrent requests into batches of up to max_batch_size images. The
+    # oldest waiting request opens a batch, which is closed when it is full or max_latency after
+    # that request arrived, so that waiting for other requests adds at most max_latency to a
+    # request's latency. Each worker thread forms and runs its own batches, so that the next
+    # batch is formed (and on GPU copied) while another one is running.
+
+    def __init__(self, model, device, precision, normalize, max_batch_size, max_latency, stats):
+        self.model = model
+        self.device = device
+        self.dtype = DTYPES[precision]
+        self.normalize = normalize
+        self.max_batch_size = max_batch_size
+        self.max_latency = max_latency
+        self.stats = stats
+        self.requests = queue.Queue()
+        self.workers = []
+
+    def submit(self, images, arrival):
+        # Blocks the connection's thread until the probabilities of the images are computed
+        future = Future()
+        self.requests.put((images, arrival, future))
+        return future.result()
+
+    def next_batch(self, carry):
+        # carry is a request that did not fit into the previous batch of this worker
+        first = carry if carry is not None else self.requests.get()
+        if first is None:
+            return None, None
+        batch, num_images = [first], len(first[0])
+        deadline = first[1] + self.max_latency
+        while num_images < self.max_batch_size:
+            # Requests that are already waiting join even after the deadline (under load)
+            timeout = deadline - time.perf_counter()
+            try:
+                request = self.requests.get(timeout=timeout) if timeout > 0 else self.requests.get_nowait()
+            except queue.Empty:
+                break
+            if request is None:
+                # Stop signal, left for the next call
+                self.requests.put(None)
+                break
+            if num_images + len(request[0]) > self.max_batch_size:
+                return batch, request
+            batch.append(request)
+            num_images += len(request[0])
+        return batch, None
+
+    def run_batch(self, batch):
+        start = time.perf_counter()
+        images = torch.cat([images for images, _, _ in batch])
+        with torch.inference_mode():
+            # uint8 images are converted and normalized on the device, as in inference.py
+            images = self.normalize(images.to(self.device, non_blocking=True).float().div_(255))
+            logits = self.model(images.to(self.dtype)).float()
+            probabilities = nn.functional.softmax(logits, dim=-1).cpu().numpy()
+        self.stats.record_batch(len(images), time.perf_counter() - start)
+        position = 0
+        for request_images, _, future in batch:
+            future.set_result(probabilities[position:position + len(request_images)])
+            position += len(request_images)
+
+    def work(self):
+        carry = None
+        while True:
+            batch, carry = self.next_batch(carry)
+            if batch is None:
+                return
+            try:
+                self.run_batch(batch)
+            except Exception as e:
+                for _, _, future in batch:
+                    future.set_exception(e)
+
+    def start(self, num_workers):
+        self.workers = [threading.Thread(target=self.work, daemon=True) for _ in range(num_workers)]
+        for worker in self.workers:
+            worker.start()
+
+    def stop(self):
+        for _ in self.workers:
+            self.requests.put(None)
+        for worker in self.workers:
+            worker.join()
+
+
+class InferenceHandler(socketserver.StreamRequestHandler):
+    # One thread per connection, which reads the requests and waits for their batches
+
+    def setup(self):
+        super().setup()
+        if self.connection.family != socket.AF_UNIX:
+            self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    def handle(self):
+        config = self.server.config
+        image_bytes = config.n_channels * config.img_size ** 2
+        self.wfile.write(HELLO.pack(config.n_channels, config.img_size, config.num_classes))
+        while True:
+            header = self.rfile.read(HEADER.size)
+            if len(header) < HEADER.size:
+                return
+            num_images, = HEADER.unpack(header)
+            if not 0 < num_images <= config.max_batch_size:
+                print(f"Closing connection: request of {num_images} images (at most {config.max_batch_size})")
+                return
+            data = self.rfile.read(num_images * image_bytes)
+            if len(data) < num_images * image_bytes:
+                return
+            arrival = time.perf_counter()
+            images = torch.frombuffer(bytearray(data), dtype=torch.uint8).view(
+                num_images, config.n_channels, config.img_size, config.img_size)
+            try:
+                probabilities = self.server.batcher.submit(images, arrival)
+            except Exception as e:
+                print(f"Closing connection: inference failed ({e})")
+                return
+            self.wfile.write(HEADER.pack(num_images) + probabilities.tobytes())
+            self.server.stats.record(time.perf_counter() - arrival, num_images)
+
+
+class TCPServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class UnixServer(socketserver.ThreadingUnixStreamServer):
+    daemon_threads = True
+
+
+def report(stats, interval, stopped):
+    while not stopped.wait(interval):
+        summary = stats.interval()
+        if summary['requests'] > 0:
+            print(f"Serving: {describe_stats(summary)}", flush=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Vision Transformer inference server with dynamic batching')
+
+    parser.add_argument('--training-output', type=str,
+                        help='Path to trained model')
+    parser.add_argument('--config', type=str,
+                        help='YAML file with model hyperparameters')
+    parser.add_argument('--socket', type=str, default=None,
+                        help='path of a Unix socket to listen on (instead of TCP)')
+    parser.add_argument('--host', type=str, default='127.0.0.1',
+                        help='address to listen on for TCP')
+    parser.add_argument('--port', type=int, default=8470,
+                        help='port to listen on for TCP')
+    parser.add_argument('--max-batch-size', type=int, default=64,
+                        help='maximum number of images per batch (and per request)')
+    parser.add_argument('--max-latency-ms', type=float, default=5.0,
+                        help='time a request waits at most for other requests to join its batch')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='threads forming and running batches')
+    parser.add_argument('--report-interval', type=float, default=10.0,
+                        help='seconds between latency and throughput reports')
+    parser.add_argument('--stats-output', type=str, default=None,
+                        help='JSON file to write the latency and throughput of the whole run to on shutdown')
+
+    parser.add_argument('--no-cuda', action='store_true', default=False,
+                        help='disables CUDA inference')
+    parser.add_argument('--precision', choices=PRECISIONS, default='fp32',
+                        help='numerical precision of the model weights and activations')
+    parser.add_argument('--from-artifact', action='store_true', default=False,
+                        help='loads the model exported with training.py --export instead of the weights')
+    parser.add_argument('--quantize', choices=['none', 'dynamic'], default='none',
+                        help='int8 dynamic quantization of the linear layers on the CPU')
+
+    args = parser.parse_args()
+
+    config = load_config(args.config)
+    config.update(vars(args))
+    config = SimpleNamespace(**config)
+
+    use_cuda = not config.no_cuda and torch.cuda.is_available()
+    device = torch.device("cuda" if use_cuda else "cpu")
+    check_precision(config.precision, device)
+    check_quantization(config.quantize, device, config.precision)
+    if config.quantize != 'none' and config.from_artifact:
+        raise RuntimeError("--quantize quantizes the model loaded from the weights, not the exported artifact")
+
+    # No loader workers, all CPUs of the process go to the compute threads
+    config.runtime = configure_runtime(config, 0, device)
+    print(f"CPU placement: {describe_runtime(config.runtime)}")
+
+    # Same model as inference.py
+    model = load_model(config, device)
+    if config.quantize == 'dynamic':
+        model = quantize_model(model, 'dynamic')
+    augmentation = BatchAugmentation(config)
+    stats = ServerStats()
+    batcher = DynamicBatcher(model, device, config.precision, augmentation.normalize, config.max_batch_size,
+                             config.max_latency_ms / 1000, stats)
+
+    # Warm-up with a full batch, so that the first requests do not pay for allocations and kernel selection
+    warmup = torch.zeros(config.max_batch_size, config.n_channels, config.img_size, config.img_size, dtype=torch.uint8)
+    batcher.run_batch([(warmup, time.perf_counter(), Future())])
+    synchronize(device)
+    stats.reset()
+
+    if config.socket is not None:
+        if os.path.exists(config.socket):
+            os.remove(config.socket)
+        server = UnixServer(config.socket, InferenceHandler)
+        address = config.socket
+    else:
+        server = TCPServer((config.host, config.port), InferenceHandler)
+        address = "{}:{}".format(*server.server_address[:2])
+    server.config, server.batcher, server.stats = config, batcher, stats
+
+    batcher.start(config.workers)
+    stopped = threading.Event()
+    reporter = threading.Thread(target=report, args=(stats, config.report_interval, stopped), daemon=True)
+    reporter.start()
+    # SIGTERM (e.g. scancel) shuts down like Ctrl-C, shutdown() has to be called from another thread
+    signal.signal(signal.SIGTERM, lambda *_: threading.Thread(target=server.shutdown).start())
+    print(f"Serving on {address}: batches of up to {config.max_batch_size} images within "
+          f"{config.max_latency_ms} ms, {config.workers} workers", flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    server.server_close()
+    stopped.set()
+    batcher.stop()
+    if config.socket is not None:
+        os.remove(config.socket)
+
+    summary = stats.total()
+    print(f"Served {describe_stats(summary)}, {summary['batches']} batches of "
+          f"{summary['mean_batch_size']:.1f} images on average ({summary['mean_batch_ms']:.1f} ms)")
+    if config.stats_output is not None:
+        with open(config.stats_output, 'w') as f:
+            json.dump(summary, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,122 @@
+#!/usr/bin/env python3
+
+import json
+import time
+import socket
+import argparse
+import threading
+import numpy as np
+
+from serve import HELLO, HEADER, latency_summary, describe_stats
+
+
+# Load generator for serve.py: every connection sends requests one after the other (closed loop)
+# or at a fixed rate with exponentially distributed gaps (open loop, --rate), and the end-to-end
+# latency of every request is measured on the client.
+
+def connect(args):
+    if args.socket is not None:
+        connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        connection.connect(args.socket)
+    else:
+        connection = socket.create_connection((args.host, args.port))
+        connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    return connection
+
+
+def request_payloads(args, n_channels, img_size, rng):
+    # A few different requests from the given .npy images (uint8 (N, C, H, W)) or random pixels
+    shape = (args.images_per_request, n_channels, img_size, img_size)
+    if args.input is not None:
+        images = np.load(args.input, mmap_mode='r')
+        if images.shape[1:] != shape[1:] or images.dtype != np.uint8:
+            raise ValueError(f"{args.input}: expected uint8 images of shape (N, {n_channels}, {img_size}, {img_size})")
+        starts = rng.integers(0, len(images) - args.images_per_request + 1, size=16)
+        batches = [np.ascontiguousarray(images[start:start + args.images_per_request]) for start in starts]
+    else:
+        batches = [rng.integers(0, 256, size=shape, dtype=np.uint8) for _ in range(16)]
+    return [HEADER.pack(args.images_per_request) + batch.tobytes() for batch in batches]
+
+
+def run_connection(args, index, start_event, results):
+    rng = np.random.default_rng(args.seed + index)
+    connection = connect(args)
+    stream = connection.makefile('rb')
+    n_channels, img_size, num_classes = HELLO.unpack(stream.read(HELLO.size))
+    payloads = request_payloads(args, n_channels, img_size, rng)
+    response_size = HEADER.size + args.images_per_request * num_classes * 4
+    latencies = []
+    start_event.wait()
+
+    next_send = time.perf_counter()
+    for i in range(args.warmup + args.requests):
+        if args.rate > 0:
+            next_send += rng.exponential(1 / args.rate)
+            time.sleep(max(next_send - time.perf_counter(), 0))
+        send_time = time.perf_counter()
+        connection.sendall(payloads[i % len(payloads)])
+        response = stream.read(response_size)
+        if len(response) < response_size:
+            raise RuntimeError("The server closed the connection")
+        if i >= args.warmup:
+            latencies.append(time.perf_counter() - send_time)
+    connection.close()
+    results[index] = latencies
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Load generator for the Vision Transformer inference server')
+
+    parser.add_argument('--socket', type=str, default=None,
+                        help='path of the Unix socket of the server (instead of TCP)')
+    parser.add_argument('--host', type=str, default='127.0.0.1',
+                        help='address of the server for TCP')
+    parser.add_argument('--port', type=int, default=8470,
+                        help='port of the server for TCP')
+    parser.add_argument('--concurrency', type=int, default=8,
+                        help='number of connections sending requests at the same time')
+    parser.add_argument('--requests', type=int, default=200,
+                        help='timed requests per connection')
+    parser.add_argument('--warmup', type=int, default=10,
+                        help='untimed requests per connection before the timed ones')
+    parser.add_argument('--images-per-request', type=int, default=1,
+                        help='number of images in each request')
+    parser.add_argument('--rate', type=float, default=0.0,
+                        help='requests per second per connection (default: send as soon as the response arrived)')
+    parser.add_argument('--input', type=str, default=None,
+                        help='.npy file with uint8 (N, C, H, W) images to send instead of random pixels')
+    parser.add_argument('--seed', type=int, default=0,
+                        help='seed of the request contents and gaps')
+    parser.add_argument('--output', type=str, default=None,
+                        help='JSON file to write the latency and throughput to')
+
+    args = parser.parse_args()
+
+    results = [None] * args.concurrency
+    start_event = threading.Event()
+    threads = [threading.Thread(target=run_connection, args=(args, i, start_event, results))
+               for i in range(args.concurrency)]
+    for thread in threads:
+        thread.start()
+    # The timing includes the warm-up requests, which are few compared to the timed ones
+    start = time.perf_counter()
+    start_event.set()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+    if any(latencies is None for latencies in results):
+        raise RuntimeError("Some connections failed")
+
+    latencies = sum(results, [])
+    num_requests = len(latencies) + args.warmup * args.concurrency
+    summary = latency_summary(latencies, num_requests, num_requests * args.images_per_request, elapsed)
+    summary.update(concurrency=args.concurrency, images_per_request=args.images_per_request, rate=args.rate)
+    print(f"Client: {describe_stats(summary)}, max {summary['latency_max_ms']:.1f} ms "
+          f"({args.concurrency} connections, {args.images_per_request} images per request)")
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump(summary, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,15 +1,12 @@
 #!/usr/bin/env python3
 
 import os
+import time
 import argparse
-import yaml
+from contextlib import nullcontext
 from types import SimpleNamespace
 import torch
 import torch.nn as nn
-from torch.utils.data import DataLoader
-import torchvision
-from torchvision.transforms import Compose, ToTensor, Resize
-from torch import optim
 import numpy as np
 from torch.hub import tqdm
 
@@ -18,86 +15,244 @@ from torch.nn.parallel import DistributedDataParallel
 from torch.utils.data.distributed import DistributedSampler
 
 from model import ViT
+from config import load_config, set_batch_sizes
+from augment import BatchAugmentation
+from runtime import configure_runtime, describe_runtime, runtime_record
+from data import build_cache, build_shards, cifar10_dataset, subset, limit_eval_batch_size, loader_workers, make_loader, DevicePrefetcher, ResumableSampler, to_device
+from precision import PRECISIONS, check_precision, autocast, cast_state_dict, weights_filename
+from metrics import reset_peak_memory, peak_memory_mb, StepTimer, ProfilerWindow, timed_comm_hook, overlap_fraction
+from export import report_compile, export_best_model
+from launcher import init_distributed
+from parallel import (wrap_model, comm_hook, make_optimizer, make_grad_scaler, model_state_dict, optimizer_state_dict,
+                      load_model_state_dict, load_optimizer_state_dict)
+from checkpoint import AsyncWriter, to_cpu, get_rng_state, set_rng_state, load_checkpoint
 
 
 class TrainEval:
 
-    def __init__(self, args, model, train_dataloader, train_sampler, val_dataloader, optimizer, criterion, device):
+    def __init__(self, args, model, train_dataloader, train_sampler, val_dataloader, optimizer, criterion, device,
+                 timer):
         self.model = model
-        self.train_dataloader = train_dataloader
+        self.train_dataloader = DevicePrefetcher(train_dataloader, device)
         self.train_sampler = train_sampler
-        self.val_dataloader = val_dataloader
+        self.val_dataloader = DevicePrefetcher(val_dataloader, device)
         self.optimizer = optimizer
         self.criterion = criterion
         self.epoch = args.epochs
         self.device = device
         self.args = args
+        self.scaler = make_grad_scaler(args)
+        self.augmentation = BatchAugmentation(args)
+        self.writer = AsyncWriter()
+        self.checkpoint_path = os.path.join(args.training_output, "checkpoint.pt")
+        self.start_epoch = 0
+        self.start_step = 0
+        self.optimizer_steps = 0
+        self.best_valid_loss = np.inf
+        self.best_train_loss = np.inf
+        self.timer = timer
+        rank = dist.get_rank() if args.dist else 0
+        self.profiler = ProfilerWindow(args.profile_start_step, args.profile_steps, device,
+                                       os.path.join(args.training_output, f"trace-rank{rank}.json"))
+        self.steps_run = 0
+
+    def save_checkpoint(self, epoch, step):
+        # Everything needed to continue training from batch `step` of `epoch`, the sampler epoch is
+        # the training epoch. Written in the background from a CPU snapshot.
+        model_state = model_state_dict(self.model, self.args)
+        optimizer_state = optimizer_state_dict(self.model, self.optimizer, self.args)
+        rng_states = [None] * dist.get_world_size() if self.args.dist else [None]
+        if self.args.dist:
+            dist.all_gather_object(rng_states, get_rng_state())
+        else:
+            rng_states[0] = get_rng_state()
+        if not self.args.dist or dist.get_rank() == 0:
+            state = to_cpu({
+                'model': model_state,
+                'optimizer': optimizer_state,
+                'scaler': self.scaler.state_dict(),
+                'epoch': epoch,
+                'step': step,
+                'optimizer_steps': self.optimizer_steps,
+                'best_valid_loss': self.best_valid_loss,
+                'best_train_loss': self.best_train_loss,
+                'rng_states': rng_states,
+            })
+            self.writer.save(state, self.checkpoint_path)
+
+    def resume(self):
+        checkpoint = load_checkpoint(self.checkpoint_path)
+        if checkpoint is None:
+            print(f"No checkpoint at {self.checkpoint_path}, starting from scratch")
+            return
+        load_model_state_dict(self.model, checkpoint['model'], self.args)
+        load_optimizer_state_dict(self.model, self.optimizer, checkpoint['optimizer'], self.args)
+        self.scaler.load_state_dict(checkpoint['scaler'])
+        self.start_epoch = checkpoint['epoch']
+        self.start_step = checkpoint['step']
+        self.optimizer_steps = checkpoint['optimizer_steps']
+        self.best_valid_loss = checkpoint['best_valid_loss']
+        self.best_train_loss = checkpoint['best_train_loss']
+        rank = dist.get_rank() if self.args.dist else 0
+        rng_states = checkpoint['rng_states']
+        set_rng_state(rng_states[rank] if rank < len(rng_states) else rng_states[0])
+        print(f"Resuming from epoch {self.start_epoch + 1}, train step {self.start_step}")
+
+    def mean_over_ranks(self, value):
+        # Losses are accumulated on the device and only reduced when they are reported
+        if self.args.dist:
+            value = value.clone()
+            dist.all_reduce(value)
+            value /= dist.get_world_size()
+        return value.item()
 
     def train_fn(self, current_epoch):
         self.model.train()
-        if self.args.dist:
-              self.train_sampler.set_epoch(current_epoch)
-        total_loss = 0.0
-
-        for t, data in enumerate(self.train_dataloader):
-            images, labels = data
-            images, labels = images.to(self.device), labels.to(self.device)
-            self.optimizer.zero_grad()
-            logits = self.model(images)
-            loss = self.criterion(logits, labels)
-            loss.backward()
-            self.optimizer.step()
-
-            if self.args.dist:
-                dist.all_reduce(loss)
-            total_loss += loss.item() / (1 if not self.args.dist else dist.get_world_size())
-            if not self.args.dist or dist.get_rank() == 0:
-                print(f"Epoch {current_epoch + 1}/{self.epoch}, train step {t}: train loss {total_loss / (t + 1)}")
+        # When resuming, the batches of this epoch that were already trained on are skipped
+        first_step = self.start_step if current_epoch == self.start_epoch else 0
+        self.train_sampler.set_epoch(current_epoch)
+        self.train_sampler.skip_samples = first_step * self.args.batch_size
+        total_loss = torch.zeros((), device=self.device)
+        num_images = 0
+        reset_peak_memory(self.device)
+        num_steps = first_step + len(self.train_dataloader)
+        accumulation_steps = self.args.accumulation_steps
+        self.optimizer.zero_grad()
+        start_time = time.perf_counter()
+
+        t = first_step - 1
+        for t, (images, labels) in enumerate(self.train_dataloader, start=first_step):
+            self.profiler.step(self.steps_run)
+            self.timer.begin(current_epoch, t, self.train_dataloader.step_wait_time,
+                             self.train_dataloader.copy_interval)
+            # Gradients are accumulated over micro-batches and only all-reduced on the last one
+            window_start = t - t % accumulation_steps
+            window_size = min(accumulation_steps, num_steps - window_start)
+            last_micro_batch = t + 1 == window_start + window_size or self.args.dry_run
+            with self.model.no_sync() if self.args.dist and not last_micro_batch else nullcontext():
+                with self.timer.phase('augment'):
+                    images, targets = self.augmentation(images, labels)
+                with self.timer.phase('forward'), autocast(self.args.precision, self.device):
+                    logits = self.model(images)
+                    loss = self.criterion(logits, targets)
+                with self.timer.phase('backward'):
+                    self.scaler.scale(loss / window_size).backward()
+            if last_micro_batch:
+                with self.timer.phase('optimizer'):
+                    self.scaler.step(self.optimizer)
+                    self.scaler.update()
+                    self.optimizer.zero_grad()
+                self.optimizer_steps += 1
+                if self.args.checkpoint_interval and self.optimizer_steps % self.args.checkpoint_interval == 0:
+                    self.save_checkpoint(current_epoch, t + 1)
+            num_images += images.shape[0]
+            self.timer.end(images.shape[0])
+            self.steps_run += 1
+
+            total_loss += loss.detach()
+            if (t + 1) % self.args.log_interval == 0:
+                # The loss is copied to the host here anyway, so resolving the timings adds no sync
+                self.timer.flush()
+                running_loss = self.mean_over_ranks(total_loss) / (t + 1 - first_step)
+                if not self.args.dist or dist.get_rank() == 0:
+                    print(f"Epoch {current_epoch + 1}/{self.epoch}, train step {t}: train loss {running_loss}, "
+                          f"data wait {1000 * self.train_dataloader.step_wait_time:.1f} ms")
             if self.args.dry_run:
                 break
 
-        return total_loss / len(self.train_dataloader)
+        train_loss = self.mean_over_ranks(total_loss) / max(t + 1 - first_step, 1)
+        if not self.args.dist or dist.get_rank() == 0:
+            epoch_time = time.perf_counter() - start_time
+            wait_time = self.train_dataloader.wait_time
+            world_size = dist.get_world_size() if self.args.dist else 1
+            print(f"Epoch {current_epoch + 1}/{self.epoch}: train loss {train_loss}, waited {wait_time:.2f} s "
+                  f"for data out of {epoch_time:.2f} s ({100 * wait_time / epoch_time:.1f}%)")
+            print(f"Epoch {current_epoch + 1}/{self.epoch}: {self.args.precision} throughput "
+                  f"{world_size * num_images / epoch_time:.1f} images/s, "
+                  f"peak memory {peak_memory_mb(self.device):.0f} MiB")
+        self.log_step_metrics(current_epoch)
+
+        return train_loss
+
+    def log_step_metrics(self, current_epoch):
+        # Mean time per step of each phase, averaged over the ranks and of the slowest rank
+        summary = self.timer.summary(current_epoch)
+        self.timer.write(summary)
+        keys = StepTimer.PHASES + ('comm_span', 'comm_exposed')
+        phase_times = torch.tensor([summary[key] / max(summary['steps'], 1) for key in keys],
+                                   dtype=torch.float64, device=self.device)
+        max_phase_times = phase_times.clone()
+        if self.args.dist:
+            dist.all_reduce(phase_times)
+            phase_times /= dist.get_world_size()
+            dist.all_reduce(max_phase_times, op=dist.ReduceOp.MAX)
+        if not self.args.dist or dist.get_rank() == 0:
+            phase_times, max_phase_times = phase_times.tolist(), max_phase_times.tolist()
+            # Fraction of the gradient communication hidden behind the backward pass
+            overlap = overlap_fraction(phase_times[-2], phase_times[-1])
+            self.timer.write({'type': 'summary', 'epoch': current_epoch, 'steps': summary['steps'],
+                              'mean': dict(zip(keys, phase_times)), 'max': dict(zip(keys, max_phase_times)),
+                              'overlap': overlap})
+            print(f"Epoch {current_epoch + 1}/{self.epoch}: ms per step " + ", ".join(
+                f"{phase} {1000 * mean:.1f} (max {1000 * slowest:.1f})"
+                for phase, mean, slowest in zip(StepTimer.PHASES, phase_times, max_phase_times))
+                + (f", comm/compute overlap {100 * overlap:.0f}%" if overlap is not None else ""))
 
     def eval_fn(self, current_epoch):
         self.model.eval()
-        total_loss = 0.0
+        # Loss sum, number of correct predictions and number of samples, reduced once at the end
+        totals = torch.zeros(3, dtype=torch.float64, device=self.device)
 
-        for t, data in enumerate(self.val_dataloader):
-            images, labels = data
-            images, labels = images.to(self.device), labels.to(self.device)
+        # FSDP's all-gathered parameter views do not work reliably as inference tensors
+        with torch.no_grad() if self.args.optimizer_sharding == 'fsdp' else torch.inference_mode():
+            for t, (images, labels) in enumerate(self.val_dataloader):
 
-            logits = self.model(images)
-            loss = self.criterion(logits, labels)
+                images = self.augmentation.normalize(images)
+                with autocast(self.args.precision, self.device):
+                    logits = self.model(images)
+                    loss = self.criterion(logits, labels)
 
-            if self.args.dist:
-                dist.all_reduce(loss)
-            total_loss += loss.item() / (1 if not self.args.dist else dist.get_world_size())
-            if self.args.dry_run:
-                break
+                totals[0] += loss.float() * labels.shape[0]
+                totals[1] += (torch.argmax(logits, dim=-1) == labels).sum()
+                totals[2] += labels.shape[0]
+                if self.args.dry_run:
+                    break
 
+        if self.args.dist:
+            dist.all_reduce(totals)
+        valid_loss, accuracy = (totals[:2] / totals[2]).tolist()
         if not self.args.dist or dist.get_rank() == 0:
-            print(f"Epoch {current_epoch + 1}/{self.epoch}: valid loss {total_loss / (t + 1)}")
+            print(f"Epoch {current_epoch + 1}/{self.epoch}: valid loss {valid_loss}, accuracy {accuracy:.4f}")
 
-        return total_loss / len(self.val_dataloader)
+        return valid_loss
 
     def train(self):
-        best_valid_loss = np.inf
-        best_train_loss = np.inf
-        for i in range(self.epoch):
+        for i in range(self.start_epoch, self.epoch):
             train_loss = self.train_fn(i)
+            # Validation every eval_interval epochs and after the last one
+            if (i + 1) % self.args.eval_interval != 0 and i + 1 != self.epoch:
+                self.save_checkpoint(i + 1, 0)
+                continue
             val_loss = self.eval_fn(i)
 
-            if val_loss < best_valid_loss:
+            if val_loss < self.best_valid_loss:
+                # Consolidated on rank 0 if the model is sharded
+                state_dict = model_state_dict(self.model, self.args)
                 if not self.args.dist or dist.get_rank() == 0:
-                    torch.save(self.model.state_dict()
-                               if not self.args.dist else
-                               self.model.module.state_dict(),
-                               os.path.join(self.args.training_output, "best-weights.pt"))
+                    state_dict = to_cpu(state_dict)
+                    self.writer.save(state_dict, os.path.join(self.args.training_output, "best-weights.pt"))
+                    if self.args.precision != 'fp32':
+                        # Reduced-precision copy for inference.py --precision
+                        self.writer.save(cast_state_dict(state_dict, self.args.precision),
+                                         os.path.join(self.args.training_output, weights_filename(self.args.precision)))
                     print("Saved Best Weights")
-                best_valid_loss = val_loss
-                best_train_loss = train_loss
-        print(f"Training Loss : {best_train_loss}")
-        print(f"Valid Loss : {best_valid_loss}")
+                self.best_valid_loss = val_loss
+                self.best_train_loss = train_loss
+            self.save_checkpoint(i + 1, 0)
+        self.profiler.stop()
+        self.writer.wait()
+        print(f"Training Loss : {self.best_train_loss}")
+        print(f"Valid Loss : {self.best_valid_loss}")
 
     '''
         On default settings:
@@ -124,6 +279,8 @@ def main():
                         help='Path to CIFAR10 test data')
     parser.add_argument('--config', type=str,
                         help='YAML file with model and training hyperparameters')
+    parser.add_argument('--runtime-config', type=str, default=None,
+                        help='YAML file from autotune.py with the workers, threads and batch size per rank')
     parser.add_argument('--training-output', type=str,
                         help='Path to save trained model to')
 
@@ -133,54 +290,113 @@ def main():
                         help='quickly check a single pass')
     parser.add_argument('--dist', action='store_true', default=False,
                         help='enables distributed training')
+    parser.add_argument('--data-cache', action='store_true', default=False,
+                        help='reads pre-resized images from a memory-mapped cache (built on first use)')
+    parser.add_argument('--data-shards', action='store_true', default=False,
+                        help='streams pre-resized records from shards, each rank reads only its own (built on first use)')
+    parser.add_argument('--precision', choices=PRECISIONS, default='fp32',
+                        help='numerical precision of the forward pass (autocast), fp16 uses gradient scaling')
+    parser.add_argument('--compile', action='store_true', default=False,
+                        help='compiles the model with torch.compile and reports the speedup')
+    parser.add_argument('--export', action='store_true', default=False,
+                        help='exports the best model as a self-contained artifact for inference.py --from-artifact')
+    parser.add_argument('--resume', action='store_true', default=False,
+                        help='continues training from the checkpoint in the training output directory')
 
     args = parser.parse_args()
 
-    with open(args.config) as f:
-        config = yaml.load(f, Loader=yaml.FullLoader)
+    config = load_config(args.config, args.runtime_config)
 
     if args.dist:
-        dist.init_process_group(backend='nccl', init_method='env://')
-        world_rank = dist.get_rank()
-        world_size = dist.get_world_size()
-        if config['global_batch_size'] % world_size != 0:
-            raise RuntimeError(f"Batch size ({config['global_batch_size']}) must be a multiple of number of processes ({world_size}).")
-        config['batch_size'] = config['global_batch_size']//world_size
+        # NCCL on GPUs, Gloo on CPUs, ranks from SLURM, torchrun or launcher.py
+        ctx = init_distributed(use_cuda=not args.no_cuda)
+        world_rank = ctx.rank
+        world_size = ctx.world_size
+        device = ctx.device
+        set_batch_sizes(config, world_size)
     else:
-        config['batch_size'] = config['global_batch_size']
+        use_cuda = not args.no_cuda and torch.cuda.is_available()
+        device = torch.device("cuda" if use_cuda else "cpu")
+        set_batch_sizes(config, 1)
 
     config.update(vars(args))
     config = SimpleNamespace(**config)
 
-    use_cuda = not config.no_cuda and torch.cuda.is_available()
-    device = torch.device("cuda" if use_cuda else "cpu")
-
-    transforms = Compose([
-        Resize((config.img_size, config.img_size)),
-        ToTensor()
-    ])
-    train_data = torchvision.datasets.CIFAR10(root=config.training_input, train=True, download=False, transform=transforms)
-    valid_data = torchvision.datasets.CIFAR10(root=config.test_input, train=False, download=False, transform=transforms)
-    if config.dist:
-        train_sampler = DistributedSampler(train_data, num_replicas=world_size, rank=world_rank)
-        valid_sampler = DistributedSampler(valid_data, num_replicas=world_size, rank=world_rank)
-        train_loader = DataLoader(train_data, batch_size=config.batch_size, sampler=train_sampler)
-        valid_loader = DataLoader(valid_data, batch_size=config.batch_size, sampler=valid_sampler)
+    check_precision(config.precision, device)
+
+    # Compute threads and loader workers on separate CPUs
+    local_rank = ctx.local_rank if config.dist else 0
+    config.num_workers = loader_workers(config, local_rank)
+    config.runtime = configure_runtime(config, config.num_workers, device, local_rank)
+    if not config.dist or world_rank == 0:
+        print(f"CPU placement: {describe_runtime(config.runtime)}")
+
+    if config.data_cache:
+        if not config.dist or world_rank == 0:
+            build_cache(config.training_input, True, config.img_size)
+            build_cache(config.test_input, False, config.img_size)
+        if config.dist:
+            dist.barrier()
+    if config.data_shards:
+        if not config.dist or world_rank == 0:
+            build_shards(config.training_input, True, config.img_size)
+            build_shards(config.test_input, False, config.img_size)
+        if config.dist:
+            dist.barrier()
+
+    rank, num_replicas = (world_rank, world_size) if config.dist else (0, 1)
+    train_data = cifar10_dataset(config.training_input, True, config, rank, num_replicas)
+    valid_data = cifar10_dataset(config.test_input, False, config, rank, num_replicas)
+    if config.eval_subset:
+        valid_data = subset(valid_data, config.eval_subset)
+    limit_eval_batch_size(valid_data, config, num_replicas)
+    # The order of training samples is determined by the epoch, so that an epoch can be resumed
+    if config.data_shards:
+        # Each rank streams its own part of the shards, the dataset orders the samples itself
+        train_sampler = train_data
+        train_loader = make_loader(train_data, config.batch_size, config)
+        valid_loader = make_loader(valid_data, config.eval_batch_size, config)
+    elif config.dist:
+        train_sampler = ResumableSampler(DistributedSampler(train_data, num_replicas=world_size, rank=world_rank))
+        valid_sampler = DistributedSampler(valid_data, num_replicas=world_size, rank=world_rank, shuffle=False)
+        train_loader = make_loader(train_data, config.batch_size, config, sampler=train_sampler)
+        valid_loader = make_loader(valid_data, config.eval_batch_size, config, sampler=valid_sampler)
     else:
-        train_loader = DataLoader(train_data, batch_size=config.batch_size, shuffle=True)
-        valid_loader = DataLoader(valid_data, batch_size=config.batch_size, shuffle=True)
+        train_sampler = ResumableSampler(DistributedSampler(train_data, num_replicas=1, rank=0))
+        train_loader = make_loader(train_data, config.batch_size, config, sampler=train_sampler)
+        valid_loader = make_loader(valid_data, config.eval_batch_size, config)
 
     model = ViT(config).to(device)
     if args.dist:
-        model = DistributedDataParallel(model,
-                                        device_ids=[int(os.environ['LOCAL_RANK'])],
-                                        output_device=[int(os.environ['LOCAL_RANK'])],
-                                        find_unused_parameters=True)
+        model = wrap_model(model, config, device)
+    else:
+        config.optimizer_sharding = 'none'
 
-    optimizer = optim.Adam(model.parameters(), lr=config.lr, weight_decay=config.weight_decay)
+    # Per-step timings of each rank as JSON lines, the gradient all-reduce of DDP is timed with a comm hook
+    metrics_path = os.path.join(config.training_output, f"metrics-rank{world_rank if config.dist else 0}.jsonl")
+    timer = StepTimer(device, metrics_path, append=config.resume)
+    timer.write(runtime_record(config.runtime))
+    if isinstance(model, DistributedDataParallel):
+        hook_state, hook = comm_hook(config)
+        model.register_comm_hook(hook_state, timed_comm_hook(timer, hook))
+
+    optimizer = make_optimizer(model, config)
     criterion = nn.CrossEntropyLoss()
 
-    TrainEval(config, model, train_loader, train_sampler if args.dist else None, valid_loader, optimizer, criterion, device).train()
+    if config.compile:
+        compiled_model = torch.compile(model)
+        images, labels = to_device(*next(iter(train_loader)), device)
+        report_compile(model, compiled_model, images, labels, criterion, config.precision)
+        model = compiled_model
+
+    train_eval = TrainEval(config, model, train_loader, train_sampler, valid_loader, optimizer, criterion, device,
+                           timer)
+    if config.resume:
+        train_eval.resume()
+    train_eval.train()
+
+    if config.export and (not config.dist or world_rank == 0):
+        export_best_model(config)
 
     if args.dist:
         dist.destroy_process_group()
@@ -1,88 +1,200 @@
 #!/usr/bin/env python3
 
 import os
+import time
 import argparse
-import yaml
 from types import SimpleNamespace
 import torch
 import torch.nn as nn
-from torch.utils.data import DataLoader
-import torchvision
-from torchvision.transforms import Compose, ToTensor, Resize
 from torch import optim
 import numpy as np
 from torch.hub import tqdm
+from torch.utils.data.distributed import DistributedSampler
 
 from model import ViT
+from config import load_config, set_batch_sizes
+from augment import BatchAugmentation
+from runtime import configure_runtime, describe_runtime, runtime_record
+from data import build_cache, build_shards, cifar10_dataset, subset, limit_eval_batch_size, loader_workers, make_loader, DevicePrefetcher, ResumableSampler, to_device
+from precision import PRECISIONS, check_precision, autocast, grad_scaler, cast_state_dict, weights_filename
+from metrics import reset_peak_memory, peak_memory_mb, StepTimer, ProfilerWindow
+from export import report_compile, export_best_model
+from parallel import unwrap_model
+from checkpoint import AsyncWriter, to_cpu, get_rng_state, set_rng_state, load_checkpoint
 
 
 class TrainEval:
 
-    def __init__(self, args, model, train_dataloader, val_dataloader, optimizer, criterion, device):
+    def __init__(self, args, model, train_dataloader, train_sampler, val_dataloader, optimizer, criterion, device,
+                 timer):
         self.model = model
-        self.train_dataloader = train_dataloader
-        self.val_dataloader = val_dataloader
+        self.train_dataloader = DevicePrefetcher(train_dataloader, device)
+        self.train_sampler = train_sampler
+        self.val_dataloader = DevicePrefetcher(val_dataloader, device)
         self.optimizer = optimizer
         self.criterion = criterion
         self.epoch = args.epochs
         self.device = device
         self.args = args
+        self.scaler = grad_scaler(args.precision)
+        self.augmentation = BatchAugmentation(args)
+        self.writer = AsyncWriter()
+        self.checkpoint_path = os.path.join(args.training_output, "checkpoint.pt")
+        self.start_epoch = 0
+        self.start_step = 0
+        self.optimizer_steps = 0
+        self.best_valid_loss = np.inf
+        self.best_train_loss = np.inf
+        self.timer = timer
+        self.profiler = ProfilerWindow(args.profile_start_step, args.profile_steps, device,
+                                       os.path.join(args.training_output, "trace-rank0.json"))
+        self.steps_run = 0
+
+    def save_checkpoint(self, epoch, step):
+        # Everything needed to continue training from batch `step` of `epoch`, the sampler epoch is
+        # the training epoch. Written in the background from a CPU snapshot.
+        state = to_cpu({
+            'model': unwrap_model(self.model).state_dict(),
+            'optimizer': self.optimizer.state_dict(),
+            'scaler': self.scaler.state_dict(),
+            'epoch': epoch,
+            'step': step,
+            'optimizer_steps': self.optimizer_steps,
+            'best_valid_loss': self.best_valid_loss,
+            'best_train_loss': self.best_train_loss,
+            'rng_states': [get_rng_state()],
+        })
+        self.writer.save(state, self.checkpoint_path)
+
+    def resume(self):
+        checkpoint = load_checkpoint(self.checkpoint_path)
+        if checkpoint is None:
+            print(f"No checkpoint at {self.checkpoint_path}, starting from scratch")
+            return
+        unwrap_model(self.model).load_state_dict(checkpoint['model'])
+        self.optimizer.load_state_dict(checkpoint['optimizer'])
+        self.scaler.load_state_dict(checkpoint['scaler'])
+        self.start_epoch = checkpoint['epoch']
+        self.start_step = checkpoint['step']
+        self.optimizer_steps = checkpoint['optimizer_steps']
+        self.best_valid_loss = checkpoint['best_valid_loss']
+        self.best_train_loss = checkpoint['best_train_loss']
+        set_rng_state(checkpoint['rng_states'][0])
+        print(f"Resuming from epoch {self.start_epoch + 1}, train step {self.start_step}")
 
     def train_fn(self, current_epoch):
         self.model.train()
-        total_loss = 0.0
+        # When resuming, the batches of this epoch that were already trained on are skipped
+        first_step = self.start_step if current_epoch == self.start_epoch else 0
+        self.train_sampler.set_epoch(current_epoch)
+        self.train_sampler.skip_samples = first_step * self.args.batch_size
+        total_loss = torch.zeros((), device=self.device)
+        num_images = 0
+        reset_peak_memory(self.device)
+        num_steps = first_step + len(self.train_dataloader)
+        accumulation_steps = self.args.accumulation_steps
+        self.optimizer.zero_grad()
+        start_time = time.perf_counter()
         tk = tqdm(self.train_dataloader, desc="EPOCH" + "[TRAIN]" + str(current_epoch + 1) + "/" + str(self.epoch))
 
-        for t, data in enumerate(tk):
-            images, labels = data
-            images, labels = images.to(self.device), labels.to(self.device)
-            self.optimizer.zero_grad()
-            logits = self.model(images)
-            loss = self.criterion(logits, labels)
-            loss.backward()
-            self.optimizer.step()
-
-            total_loss += loss.item()
-            tk.set_postfix({"Loss": "%6f" % float(total_loss / (t + 1))})
+        t = first_step - 1
+        for t, (images, labels) in enumerate(tk, start=first_step):
+            self.profiler.step(self.steps_run)
+            self.timer.begin(current_epoch, t, self.train_dataloader.step_wait_time,
+                             self.train_dataloader.copy_interval)
+            # Gradients are accumulated over micro-batches before each optimizer step
+            window_start = t - t % accumulation_steps
+            window_size = min(accumulation_steps, num_steps - window_start)
+            with self.timer.phase('augment'):
+                images, targets = self.augmentation(images, labels)
+            with self.timer.phase('forward'), autocast(self.args.precision, self.device):
+                logits = self.model(images)
+                loss = self.criterion(logits, targets)
+            with self.timer.phase('backward'):
+                self.scaler.scale(loss / window_size).backward()
+            if t + 1 == window_start + window_size or self.args.dry_run:
+                with self.timer.phase('optimizer'):
+                    self.scaler.step(self.optimizer)
+                    self.scaler.update()
+                    self.optimizer.zero_grad()
+                self.optimizer_steps += 1
+                if self.args.checkpoint_interval and self.optimizer_steps % self.args.checkpoint_interval == 0:
+                    self.save_checkpoint(current_epoch, t + 1)
+            num_images += images.shape[0]
+            self.timer.end(images.shape[0])
+            self.steps_run += 1
+
+            # Accumulated on the device, the loss is only copied to the host when it is reported
+            total_loss += loss.detach()
+            if (t + 1) % self.args.log_interval == 0:
+                self.timer.flush()
+                tk.set_postfix({"Loss": "%6f" % (total_loss.item() / (t + 1 - first_step)),
+                                "Wait": "%.1fms" % (1000 * self.train_dataloader.step_wait_time)})
             if self.args.dry_run:
                 break
 
-        return total_loss / len(self.train_dataloader)
+        train_loss = total_loss.item() / max(t + 1 - first_step, 1)
+        epoch_time = time.perf_counter() - start_time
+        wait_time = self.train_dataloader.wait_time
+        print(f"Waited {wait_time:.2f} s for data out of {epoch_time:.2f} s ({100 * wait_time / epoch_time:.1f}%)")
+        print(f"{self.args.precision} throughput {num_images / epoch_time:.1f} images/s, "
+              f"peak memory {peak_memory_mb(self.device):.0f} MiB")
+        summary = self.timer.summary(current_epoch)
+        self.timer.write(summary)
+        print("ms per step " + ", ".join(f"{phase} {1000 * summary[phase] / max(summary['steps'], 1):.1f}"
+                                         for phase in StepTimer.PHASES if phase != 'comm'))
+
+        return train_loss
 
     def eval_fn(self, current_epoch):
         self.model.eval()
-        total_loss = 0.0
+        # Loss sum, number of correct predictions and number of samples, copied to the host at the end
+        totals = torch.zeros(3, dtype=torch.float64, device=self.device)
         tk = tqdm(self.val_dataloader, desc="EPOCH" + "[VALID]" + str(current_epoch + 1) + "/" + str(self.epoch))
 
-        for t, data in enumerate(tk):
-            images, labels = data
-            images, labels = images.to(self.device), labels.to(self.device)
+        with torch.inference_mode():
+            for t, (images, labels) in enumerate(tk):
 
-            logits = self.model(images)
-            loss = self.criterion(logits, labels)
+                images = self.augmentation.normalize(images)
+                with autocast(self.args.precision, self.device):
+                    logits = self.model(images)
+                    loss = self.criterion(logits, labels)
 
-            total_loss += loss.item()
-            tk.set_postfix({"Loss": "%6f" % float(total_loss / (t + 1))})
-            if self.args.dry_run:
-                break
+                totals[0] += loss.float() * labels.shape[0]
+                totals[1] += (torch.argmax(logits, dim=-1) == labels).sum()
+                totals[2] += labels.shape[0]
+                if self.args.dry_run:
+                    break
 
-        return total_loss / len(self.val_dataloader)
+        valid_loss, accuracy = (totals[:2] / totals[2]).tolist()
+        print(f"Valid loss {valid_loss}, accuracy {accuracy:.4f}")
+
+        return valid_loss
 
     def train(self):
-        best_valid_loss = np.inf
-        best_train_loss = np.inf
-        for i in range(self.epoch):
+        for i in range(self.start_epoch, self.epoch):
             train_loss = self.train_fn(i)
+            # Validation every eval_interval epochs and after the last one
+            if (i + 1) % self.args.eval_interval != 0 and i + 1 != self.epoch:
+                self.save_checkpoint(i + 1, 0)
+                continue
             val_loss = self.eval_fn(i)
 
-            if val_loss < best_valid_loss:
-                torch.save(self.model.state_dict(),
-                           os.path.join(self.args.training_output, "best-weights.pt"))
+            if val_loss < self.best_valid_loss:
+                state_dict = to_cpu(unwrap_model(self.model).state_dict())
+                self.writer.save(state_dict, os.path.join(self.args.training_output, "best-weights.pt"))
+                if self.args.precision != 'fp32':
+                    # Reduced-precision copy for inference.py --precision
+                    self.writer.save(cast_state_dict(state_dict, self.args.precision),
+                                     os.path.join(self.args.training_output, weights_filename(self.args.precision)))
                 print("Saved Best Weights")
-                best_valid_loss = val_loss
-                best_train_loss = train_loss
-        print(f"Training Loss : {best_train_loss}")
-        print(f"Valid Loss : {best_valid_loss}")
+                self.best_valid_loss = val_loss
+                self.best_train_loss = train_loss
+            self.save_checkpoint(i + 1, 0)
+        self.profiler.stop()
+        self.writer.wait()
+        print(f"Training Loss : {self.best_train_loss}")
+        print(f"Valid Loss : {self.best_valid_loss}")
 
     '''
         On default settings:
@@ -109,6 +221,8 @@ def main():
                         help='Path to CIFAR10 test data')
     parser.add_argument('--config', type=str,
                         help='YAML file with model and training hyperparameters')
+    parser.add_argument('--runtime-config', type=str, default=None,
+                        help='YAML file from autotune.py with the workers, threads and batch size per rank')
     parser.add_argument('--training-output', type=str,
                         help='Path to save trained model to')
 
@@ -116,33 +230,80 @@ def main():
                         help='disables CUDA training')
     parser.add_argument('--dry-run', action='store_true', default=False,
                         help='quickly check a single pass')
+    parser.add_argument('--data-cache', action='store_true', default=False,
+                        help='reads pre-resized images from a memory-mapped cache (built on first use)')
+    parser.add_argument('--data-shards', action='store_true', default=False,
+                        help='streams pre-resized records from shards, each rank reads only its own (built on first use)')
+    parser.add_argument('--precision', choices=PRECISIONS, default='fp32',
+                        help='numerical precision of the forward pass (autocast), fp16 uses gradient scaling')
+    parser.add_argument('--compile', action='store_true', default=False,
+                        help='compiles the model with torch.compile and reports the speedup')
+    parser.add_argument('--export', action='store_true', default=False,
+                        help='exports the best model as a self-contained artifact for inference.py --from-artifact')
+    parser.add_argument('--resume', action='store_true', default=False,
+                        help='continues training from the checkpoint in the training output directory')
 
     args = parser.parse_args()
 
-    with open(args.config) as f:
-        config = yaml.load(f, Loader=yaml.FullLoader)
+    config = load_config(args.config, args.runtime_config)
 
+    set_batch_sizes(config, 1)  # not performed in parallel
     config.update(vars(args))
     config = SimpleNamespace(**config)
 
     use_cuda = not config.no_cuda and torch.cuda.is_available()
     device = torch.device("cuda" if use_cuda else "cpu")
+    check_precision(config.precision, device)
+
+    # Compute threads and loader workers on separate CPUs
+    config.num_workers = loader_workers(config)
+    config.runtime = configure_runtime(config, config.num_workers, device)
+    print(f"CPU placement: {describe_runtime(config.runtime)}")
+
+    if config.data_cache:
+        build_cache(config.training_input, True, config.img_size)
+        build_cache(config.test_input, False, config.img_size)
+    if config.data_shards:
+        build_shards(config.training_input, True, config.img_size)
+        build_shards(config.test_input, False, config.img_size)
 
-    transforms = Compose([
-        Resize((config.img_size, config.img_size)),
-        ToTensor()
-    ])
-    train_data = torchvision.datasets.CIFAR10(root=config.training_input, train=True, download=False, transform=transforms)
-    valid_data = torchvision.datasets.CIFAR10(root=config.test_input, train=False, download=False, transform=transforms)
-    train_loader = DataLoader(train_data, batch_size=config.batch_size, shuffle=True)
-    valid_loader = DataLoader(valid_data, batch_size=config.batch_size, shuffle=True)
+    train_data = cifar10_dataset(config.training_input, True, config)
+    valid_data = cifar10_dataset(config.test_input, False, config)
+    # The order of training samples is determined by the epoch, so that an epoch can be resumed.
+    # A ShardedDataset orders the samples itself.
+    if config.data_shards:
+        train_sampler = train_data
+        train_loader = make_loader(train_data, config.batch_size, config)
+    else:
+        train_sampler = ResumableSampler(DistributedSampler(train_data, num_replicas=1, rank=0))
+        train_loader = make_loader(train_data, config.batch_size, config, sampler=train_sampler)
+    if config.eval_subset:
+        valid_data = subset(valid_data, config.eval_subset)
+    limit_eval_batch_size(valid_data, config)
+    valid_loader = make_loader(valid_data, config.eval_batch_size, config)
 
     model = ViT(config).to(device)
+    # Per-step timings as JSON lines
+    timer = StepTimer(device, os.path.join(config.training_output, "metrics-rank0.jsonl"), append=config.resume)
+    timer.write(runtime_record(config.runtime))
 
     optimizer = optim.Adam(model.parameters(), lr=config.lr, weight_decay=config.weight_decay)
     criterion = nn.CrossEntropyLoss()
 
-    TrainEval(config, model, train_loader, valid_loader, optimizer, criterion, device).train()
+    if config.compile:
+        compiled_model = torch.compile(model)
+        images, labels = to_device(*next(iter(train_loader)), device)
+        report_compile(model, compiled_model, images, labels, criterion, config.precision)
+        model = compiled_model
+
+    train_eval = TrainEval(config, model, train_loader, train_sampler, valid_loader, optimizer, criterion, device,
+                           timer)
+    if config.resume:
+        train_eval.resume()
+    train_eval.train()
+
+    if config.export:
+        export_best_model(config)
 
 
 if __name__ == "__main__":
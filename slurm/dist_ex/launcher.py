@@ -0,0 +1 @@
+../../sarus/dist_ex/launcher.py
\ No newline at end of file
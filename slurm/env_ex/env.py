@@ -1,12 +1,120 @@
 import os
-import socket
+import glob
 import json
+import socket
+import argparse
+import subprocess
+
+# Besides the SLURM environment, probes the resources of the allocation on this node: CPUs and
+# their NUMA nodes, memory, and GPUs (through PyTorch if it is installed, otherwise nvidia-smi).
+# Only the standard library is required. The launch parameters for an allocation are
+# recommended by sarus/vit_ex/autotune.py, which plans the ranks, workers and threads of training.
+
+
+def read_meminfo(path):
+    # Values of /proc/meminfo or a NUMA node's meminfo in MiB
+    info = {}
+    with open(path) as f:
+        for line in f:
+            fields = line.replace(':', ' ').split()
+            if fields[-1] == 'kB':
+                info[fields[-3]] = int(fields[-2]) // 1024
+    return info
+
+
+def slurm_allocation():
+    env = os.environ
+    return {'job_id': env.get('SLURM_JOB_ID'), 'partition': env.get('SLURM_JOB_PARTITION'),
+            'nodes': int(env.get('SLURM_JOB_NUM_NODES', env.get('SLURM_NNODES', 1))),
+            'nodelist': env.get('SLURM_JOB_NODELIST'),
+            'ntasks': int(env['SLURM_NTASKS']) if 'SLURM_NTASKS' in env else None,
+            'ntasks_per_node': env.get('SLURM_NTASKS_PER_NODE'),
+            'cpus_per_task': int(env['SLURM_CPUS_PER_TASK']) if 'SLURM_CPUS_PER_TASK' in env else None,
+            'cpus_on_node': int(env['SLURM_CPUS_ON_NODE']) if 'SLURM_CPUS_ON_NODE' in env else None,
+            'gpus_on_node': int(env['SLURM_GPUS_ON_NODE']) if 'SLURM_GPUS_ON_NODE' in env else None,
+            'mem_per_node_mb': int(env['SLURM_MEM_PER_NODE']) if 'SLURM_MEM_PER_NODE' in env else None}
+
+
+def cpu_layout():
+    # CPUs this process may run on, grouped by NUMA node, with the free memory of each node
+    cpus = sorted(os.sched_getaffinity(0))
+    numa = {}
+    for path in sorted(glob.glob('/sys/devices/system/node/node[0-9]*')):
+        node = int(os.path.basename(path)[len('node'):])
+        # The node's directory links to each of its CPUs
+        node_cpus = {int(os.path.basename(cpu)[len('cpu'):]) for cpu in glob.glob(os.path.join(path, 'cpu[0-9]*'))}
+        node_cpus = sorted(node_cpus & set(cpus))
+        if node_cpus:
+            numa[node] = {'cpus': node_cpus,
+                          'free_mb': read_meminfo(os.path.join(path, 'meminfo')).get('MemFree')}
+    if not numa:
+        numa[0] = {'cpus': cpus, 'free_mb': None}
+    return {'online': os.cpu_count(), 'allowed': len(cpus), 'numa_nodes': numa}
+
+
+def memory():
+    info = read_meminfo('/proc/meminfo')
+    result = {'total_mb': info.get('MemTotal'), 'available_mb': info.get('MemAvailable')}
+    # Memory limit of the job's cgroup (cgroup v2 or v1), if any
+    for path in ('/sys/fs/cgroup/memory.max', '/sys/fs/cgroup/memory/memory.limit_in_bytes'):
+        try:
+            with open(path) as f:
+                limit = f.read().strip()
+        except OSError:
+            continue
+        if limit.isdigit() and int(limit) < 2**60:
+            result['cgroup_limit_mb'] = int(limit) // 2**20
+        break
+    return result
+
+
+def accelerators():
+    try:
+        import torch
+    except ImportError:
+        torch = None
+    if torch is not None and torch.cuda.is_available():
+        gpus = []
+        for index in range(torch.cuda.device_count()):
+            free, total = torch.cuda.mem_get_info(index)
+            gpus.append({'index': index, 'name': torch.cuda.get_device_name(index),
+                         'total_mb': total // 2**20, 'free_mb': free // 2**20})
+        return gpus
+    try:
+        output = subprocess.run(['nvidia-smi', '--query-gpu=index,name,memory.total,memory.free',
+                                 '--format=csv,noheader,nounits'], capture_output=True, text=True).stdout
+    except OSError:
+        return []
+    gpus = []
+    for line in output.strip().splitlines():
+        index, name, total, free = [field.strip() for field in line.split(',')]
+        gpus.append({'index': int(index), 'name': name, 'total_mb': int(total), 'free_mb': int(free)})
+    return gpus
+
+
+def main():
+    parser = argparse.ArgumentParser(description='SLURM environment and node topology')
+    parser.add_argument('--output', type=str, default=None,
+                        help='JSON file to write the topology to')
+    args = parser.parse_args()
+
+    hostname = socket.gethostname()
+    print(f"Hello from {hostname}")
+
+    print(f"The SLURM environment is")
+
+    slurm_env = {k: v for k, v in os.environ.items() if k.startswith('SLURM_')}
+    print(json.dumps(slurm_env, indent=4))
 
-hostname = socket.gethostname()
-print(f"Hello from {hostname}")
+    topology = {'hostname': hostname, 'slurm': slurm_allocation(), 'cpus': cpu_layout(), 'memory': memory(),
+                'accelerators': accelerators()}
+    print(f"The topology of the allocation on this node is")
+    print(json.dumps(topology, indent=4))
 
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump(topology, f, indent=4)
 
-print(f"The SLURM environment is")
 
-slurm_env = {k: v for k, v in os.environ.items() if k.startswith('SLURM_')}
-print(json.dumps(slurm_env, indent=4))
\ No newline at end of file
+if __name__ == "__main__":
+    main()